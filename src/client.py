@@ -1,21 +1,53 @@
 from threading import Thread
+from engine import PeerEngine
+from dialer import PeerDialer
 from peer import Peer
+from rate_limit import create_bandwidth_bucket
 from torrent import Torrent
 from tracker import Tracker
+from tracker_client import TrackerClient
 import random
 import time
-import select
-import socket
 
 CLIENT_ID = "FA"
 CLIENT_VERSION = "0000"
 DEBUG_MODE = True
+# Ask trackers for 6-byte packed peer entries instead of dictionaries
+REQUEST_COMPACT_PEER_LIST = True
 
+# Rate limits are in bytes per second, None means unlimited
+# upload_rate_limit and download_rate_limit cover every torrent of the client together, the torrent limits each torrent
+# and the peer limits each connection
 class Client():
-    def __init__(self, address: str, port: int, save_path: str):
+    def __init__(
+        self,
+        address: str,
+        port: int,
+        save_path: str,
+        tracker_client: TrackerClient = None,
+        max_concurrent_dials: int = PeerDialer.DEFAULT_CONCURRENCY,
+        upload_rate_limit: float = None,
+        download_rate_limit: float = None,
+        torrent_upload_rate_limit: float = None,
+        torrent_download_rate_limit: float = None,
+        peer_upload_rate_limit: float = None,
+        peer_download_rate_limit: float = None
+    ):
         self.client_peer = Peer(address, port, Client.generate_peer_id(), False)
         self.save_path = save_path
+        # Keeps connections to trackers alive between announces
+        self.tracker_client = tracker_client if tracker_client else TrackerClient()
         self.connected_peers: dict[str, Peer] = {}
+        # Event loop serving every connected peer while downloading
+        self.engine: PeerEngine = None
+        # Opens connections to new peers in the background and hands them to the engine
+        self.dialer = PeerDialer(self.add_peer, max_concurrent_dials)
+        self.upload_bucket = create_bandwidth_bucket(upload_rate_limit)
+        self.download_bucket = create_bandwidth_bucket(download_rate_limit)
+        self.torrent_upload_rate_limit = torrent_upload_rate_limit
+        self.torrent_download_rate_limit = torrent_download_rate_limit
+        self.peer_upload_rate_limit = peer_upload_rate_limit
+        self.peer_download_rate_limit = peer_download_rate_limit
         self.current_tracker_url = None
         self.thread = None
         self.running = False
@@ -31,25 +63,22 @@ class Client():
         return '-' + CLIENT_ID + CLIENT_VERSION + '-' + ''.join(random.choices('0123456789', k=12))
 
 
+    """Announce to all trackers concurrently, the first successful response is used"""
     def try_tracker_urls(self, torrent: Torrent, tracker_urls: list):
-        latest_response = None
-
-        for tracker_url in tracker_urls:
-            tracker_response = Tracker.send_tracker_request(
-                self.client_peer.peer_id,
-                self.client_peer.port,
-                self.client_peer.address,
-                tracker_url,
-                torrent.info_hash,
-                self.seeding
-            )
-            latest_response = tracker_response
-
-            if tracker_response[0] == 200:
-                self.current_tracker_url = tracker_url
-                return tracker_response
+        tracker_url, tracker_response = self.tracker_client.announce_all(
+            tracker_urls,
+            self.client_peer.peer_id,
+            self.client_peer.port,
+            self.client_peer.address,
+            torrent.info_hash,
+            self.seeding,
+            compact=int(REQUEST_COMPACT_PEER_LIST)
+        )
+
+        if tracker_response and tracker_response[0] == 200:
+            self.current_tracker_url = tracker_url
 
-        return latest_response
+        return tracker_response
 
 
     def join_swarm(self, torrent: Torrent):
@@ -57,42 +86,50 @@ class Client():
         if self.current_tracker_url:
             tracker_response = self.try_tracker_urls(torrent, [self.current_tracker_url])
             # Check if status code is success
-            if tracker_response[0] == 200:
+            if tracker_response and tracker_response[0] == 200:
                 return tracker_response
 
         # Not in swarm or lost connection with current tracker
-        if tracker_urls := torrent.tracker_list.get("http"):
+        if tracker_urls := torrent.tracker_list.get("udp", []) + torrent.tracker_list.get("http", []):
             return self.try_tracker_urls(torrent, tracker_urls)
 
         return None
 
 
-    def try_connect_to_peer(self, info_hash: str, peer_info: dict):
-        peer = Peer(
-            peer_info["ip"],
-            peer_info["port"],
-            peer_info["peer id"],
-            peer_info["seeding"]
-        )
-        connected = peer.request_connection()
-
-        if connected and peer.initiate_handshake(info_hash, self.client_peer.peer_id, peer.peer_id):
-            return peer
-        
-        return None
+    def is_connected_to(self, address: str, port: int):
+        # Copied first, dialer threads and the engine add and remove peers concurrently
+        for peer in list(self.connected_peers.values()):
+            if peer.address == address and peer.port == port:
+                return True
+        return False
 
 
     def connect_to_peers(self, info_hash: str, tracker_response: dict):
-        for peer_info in tracker_response["peers"]:
-            # Only attempt to connect with seeding peers
-            if self.connected_peers.get(peer_info["peer id"]) or not peer_info["seeding"]:
+        for peer_info in Tracker.decode_peer_list(tracker_response.get("peers", [])):
+            # Compact peer lists do not include the seeding status (None), so only skip known leechers
+            if peer_info["seeding"] is not None and not peer_info["seeding"]:
+                continue
+            # Compact peer lists do not include peer ids either, so also check the address
+            if self.connected_peers.get(peer_info["peer id"]) or self.is_connected_to(peer_info["ip"], peer_info["port"]):
                 continue
-            if peer := self.try_connect_to_peer(info_hash, peer_info):
-                self.connected_peers[peer.peer_id] = peer
+            if (peer_info["ip"], peer_info["port"]) == (self.client_peer.address, self.client_peer.port):
+                continue
+            self.dialer.dial(info_hash, self.client_peer.peer_id, peer_info)
 
-                if DEBUG_MODE:
-                    print(f"Connected to: {peer.peer_id, peer.address, peer.port}")
-                    print(f"Completed handshake with {peer.peer_id, peer.address, peer.port}")
+
+    """Called by the dialer once a peer completed its handshake"""
+    def add_peer(self, peer: Peer):
+        # Same peer reached through another address
+        if peer.peer_id in self.connected_peers or not self.engine:
+            peer.disconnect()
+            return
+
+        self.connected_peers[peer.peer_id] = peer
+        self.engine.add_peer(peer)
+
+        if DEBUG_MODE:
+            print(f"Connected to: {peer.peer_id, peer.address, peer.port}")
+            print(f"Completed handshake with {peer.peer_id, peer.address, peer.port}")
 
 
     """Periodically send requests to all available trackers for a torrent until successful"""
@@ -124,93 +161,77 @@ class Client():
         self.thread.start()
 
 
+    """Called by the engine after a peer disconnected"""
+    def remove_peer(self, peer: Peer):
+        if self.connected_peers.get(peer.peer_id) is peer:
+            del self.connected_peers[peer.peer_id]
+
+
+    def create_engine(self, torrent: Torrent):
+        return PeerEngine(
+            torrent,
+            self.save_path,
+            self.client_peer.peer_id,
+            self.accept_peer,
+            self.remove_peer,
+            upload_buckets=[self.upload_bucket, create_bandwidth_bucket(self.torrent_upload_rate_limit)],
+            download_buckets=[self.download_bucket, create_bandwidth_bucket(self.torrent_download_rate_limit)],
+            peer_upload_rate=self.peer_upload_rate_limit,
+            peer_download_rate=self.peer_download_rate_limit
+        )
+
+
     def start_downloading(self, torrent: Torrent):
+        # Created before the tracker thread starts handing it peers
+        self.engine = self.create_engine(torrent)
         self.start_tracker_requests(torrent)
 
         if DEBUG_MODE:
             print("MY PEER INFO: ", self.client_peer.peer_id, self.client_peer.address)
 
         try:
-            while self.running:
-                # TODO: SEND REQUEST MESSAGES FOR PIECES
-                #Download from connected peers
-                for peer in self.connected_peers.values():
-                    peer: Peer
-                    peer.recv_message(torrent)
-
+            self.engine.run()
         except (SystemExit, KeyboardInterrupt):
             self.stop()
 
 
-    def get_peer_by_socket(self, socket: socket.socket):
-        for peer in self.connected_peers.values():
-            if peer.socket == socket:
-                return peer
-        return None
-
-
-    def accept_connection(self, torrent: Torrent):
-        peer = self.client_peer.accept_connection()
-        if not peer:
-            return None
-        
-        if DEBUG_MODE:
-            print(f"Accepted connection from: {peer.address, peer.port}")
-
-        received_handshake = peer.respond_handshake(torrent.info_hash, self.client_peer.peer_id)
-        if not received_handshake:
-            return None
+    """Called by the engine once an incoming peer completed its handshake, returns False to reject it"""
+    def accept_peer(self, peer: Peer):
+        if peer.peer_id in self.connected_peers:
+            return False
 
-        peer.peer_id = received_handshake.peer_id
         self.connected_peers[peer.peer_id] = peer
-
-        if DEBUG_MODE:
-            print(f"Completed handshake with {peer.peer_id, peer.address, peer.port}")
-
-        return peer
+        return True
 
 
     def start_seeding(self, torrent: Torrent):
         self.seeding = True
+        self.engine = self.create_engine(torrent)
         self.start_tracker_requests(torrent)
 
-        self.client_peer.start_listening()
+        if not self.client_peer.start_listening():
+            self.stop()
+            return
+
+        # Incoming connections, their handshakes and requests are all handled by the engine
+        self.engine.listen(self.client_peer.socket)
 
         if DEBUG_MODE:
             print("MY PEER INFO: ", self.client_peer.peer_id, self.client_peer.address, self.client_peer.port)
 
         try:
-            while self.running:
-                socket_list = [self.client_peer.socket]
-                readable, _, exceptional = select.select(socket_list, [], socket_list, 1)
-
-                for sock in readable:
-                    if sock == self.client_peer.socket:
-                        peer: Peer = self.accept_connection(torrent)
-                        if peer is None:
-                            continue
-
-                        # Test: Send a block to the connected peer
-                        for piece in torrent.pieces:
-                            for i in range(len(piece.blocks)):
-                                peer.send_block(piece, i)
-                    else:
-                        sock: socket.socket
-
-                        # TODO: SEND PARSE MESSAGES FROM PEERS
-                        # RESPOND TO REQUESTS WITH PIECE MESSAGE
-                
-                for sock in exceptional:
-                    if peer := self.get_peer_by_socket(sock):
-                        del self.connected_peers[peer.peer_id]
-
+            self.engine.run()
         except (SystemExit, KeyboardInterrupt):
             self.stop()
 
 
     def stop(self):
         self.running = False
+        if self.engine:
+            self.engine.stop()
 
 
     def __del__(self):
         self.stop()
+        self.tracker_client.close()
+        self.dialer.close()
@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from peer import Peer
+import time
+
+DEBUG_MODE = True
+
+# Connects to peers from a bounded pool of threads, so unreachable peers never hold up the tracker thread
+# Peers which completed their handshake are passed to on_connected, failed peers are retried with exponential backoff
+class PeerDialer():
+    # Number of connection attempts in flight at the same time
+    DEFAULT_CONCURRENCY = 16
+    # Seconds to wait for a peer to accept the connection, and then for its handshake
+    DEFAULT_CONNECT_TIMEOUT = 3
+    DEFAULT_HANDSHAKE_TIMEOUT = 5
+    # Seconds before the first retry of a failed peer, doubled after every further failure up to the maximum
+    INITIAL_BACKOFF = 5
+    MAX_BACKOFF = 300
+
+
+    def __init__(self, on_connected, max_concurrent: int = DEFAULT_CONCURRENCY, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, handshake_timeout: float = DEFAULT_HANDSHAKE_TIMEOUT):
+        self.on_connected = on_connected
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.executor = ThreadPoolExecutor(max_concurrent, "peer-dialer")
+        self.lock = Lock()
+        # Endpoints with a connection attempt queued or in flight
+        self.dialing: set[tuple[str, int]] = set()
+        # Endpoints whose last attempt failed, (address, port) -> (consecutive failures, time of the next allowed attempt)
+        self.failures: dict[tuple[str, int], tuple[int, float]] = {}
+
+
+    """Queue a connection attempt, returns False when the peer is already being dialed or is backing off"""
+    def dial(self, info_hash: bytes, client_peer_id: str, peer_info: dict):
+        endpoint = (peer_info["ip"], peer_info["port"])
+
+        with self.lock:
+            if endpoint in self.dialing:
+                return False
+
+            _, retry_time = self.failures.get(endpoint, (0, 0))
+            if time.time() < retry_time:
+                return False
+
+            self.dialing.add(endpoint)
+
+        try:
+            self.executor.submit(self.connect, info_hash, client_peer_id, peer_info)
+        except RuntimeError:
+            # Dialer was closed
+            with self.lock:
+                self.dialing.discard(endpoint)
+            return False
+
+        return True
+
+
+    def connect(self, info_hash: bytes, client_peer_id: str, peer_info: dict):
+        endpoint = (peer_info["ip"], peer_info["port"])
+        peer = Peer(peer_info["ip"], peer_info["port"], peer_info["peer id"], peer_info["seeding"])
+
+        try:
+            peer.socket.settimeout(self.connect_timeout)
+            connected = peer.request_connection()
+
+            peer.socket.settimeout(self.handshake_timeout)
+            if connected and peer.initiate_handshake(info_hash, client_peer_id, peer.peer_id):
+                with self.lock:
+                    self.failures.pop(endpoint, None)
+                self.on_connected(peer)
+                return
+
+            peer.disconnect()
+            self.record_failure(endpoint)
+        except Exception as e:
+            if DEBUG_MODE:
+                print(f"Failed to connect to {endpoint}: {e}")
+            peer.disconnect()
+            self.record_failure(endpoint)
+        finally:
+            with self.lock:
+                self.dialing.discard(endpoint)
+
+
+    def record_failure(self, endpoint: tuple[str, int]):
+        with self.lock:
+            failure_count = self.failures.get(endpoint, (0, 0))[0] + 1
+            backoff = min(PeerDialer.MAX_BACKOFF, PeerDialer.INITIAL_BACKOFF * 2 ** (failure_count - 1))
+            self.failures[endpoint] = (failure_count, time.time() + backoff)
+
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,734 @@
+from bitstring import BitArray
+from peer import Peer, FileSegment
+from picker import PiecePicker
+from piece import Piece
+from block import Block, BLOCK_SIZE
+from rate_limit import TokenBucket
+from torrent import Torrent
+import collections
+import math
+import message
+import random
+import rate_limit
+import selectors
+import socket
+import sys
+import time
+import util
+
+DEBUG_MODE = True
+# Seconds the event loop waits for socket events before doing periodic work
+TICK_INTERVAL = 0.5
+# Send a keep-alive to peers we have not sent anything to for this many seconds
+KEEP_ALIVE_INTERVAL = 60
+# Disconnect peers which have not sent anything, not even a keep-alive, for this many seconds
+PEER_TIMEOUT = 120
+# Block requests kept outstanding with a peer before its throughput and round trip time are known, and the bounds
+# of the adapted depth. The maximum stays below MAX_UPLOAD_QUEUE, which other clients of ours would drop requests past
+INITIAL_REQUEST_DEPTH = 4
+MIN_REQUEST_DEPTH = 2
+MAX_REQUEST_DEPTH = 200
+# Outstanding requests cover this many bandwidth-delay products, more than one so the depth can grow until the
+# peer's link rather than the pipeline limits the rate
+REQUEST_DEPTH_BDP_FACTOR = 2
+# Seconds after which the round trip time measured so far is forgotten, so it can follow a path which got slower
+RTT_WINDOW = 10
+# Requests which have not been answered after this many seconds are requested again, possibly from another peer
+REQUEST_TIMEOUT = 30
+# Disconnect incoming peers which have not sent a complete handshake after this many seconds
+HANDSHAKE_TIMEOUT = 10
+# Requests from a peer waiting to be answered, further requests are ignored
+MAX_UPLOAD_QUEUE = 256
+# Requested blocks are only added to the send queue while it holds less than this many bytes,
+# so a peer requesting many blocks does not get all of them queued at once
+SEND_BUFFER_LOW_WATERMARK = 4 * BLOCK_SIZE
+# Interested peers unchoked at the same time, one of the slots is the optimistic unchoke
+UPLOAD_SLOTS = 4
+# Seconds between choking rounds, and between changes of the optimistically unchoked peer
+CHOKE_INTERVAL = 10
+OPTIMISTIC_UNCHOKE_INTERVAL = 30
+
+# Multiplexes every peer connection of a torrent on one thread with a selectors loop
+# Outgoing connections are handed over after their handshake, incoming ones are accepted and handshaken here
+# Messages are dispatched as soon as a complete one has arrived, and outgoing messages are buffered per peer
+# Everything queued for a peer during one pass of the loop is written together at the end of the pass,
+# and again whenever its socket becomes writable
+# Bandwidth limits are token buckets in bytes: upload_buckets and download_buckets are shared by every peer (client and
+# torrent wide limits), peer_upload_rate and peer_download_rate give each peer a bucket of its own
+class PeerEngine():
+    def __init__(
+        self,
+        torrent: Torrent,
+        save_path: str,
+        peer_id: str,
+        on_handshake = None,
+        on_disconnect = None,
+        upload_slots: int = UPLOAD_SLOTS,
+        upload_buckets: list[TokenBucket] = None,
+        download_buckets: list[TokenBucket] = None,
+        peer_upload_rate: float = None,
+        peer_download_rate: float = None
+    ):
+        self.torrent = torrent
+        self.save_path = save_path
+        self.peer_id = peer_id
+        # Called with each incoming peer after its handshake, the peer is disconnected when it returns False
+        self.on_handshake = on_handshake
+        # Called with the peer after its connection was closed
+        self.on_disconnect = on_disconnect
+        self.selector = selectors.DefaultSelector()
+        self.peers: set[Peer] = set()
+        self.listener: socket.socket = None
+        self.running = False
+        self.last_tick = time.time()
+        self.last_rtt_window = time.monotonic()
+        # Decides which blocks are requested from which peer, and keeps track of the requests in flight
+        self.picker = PiecePicker(torrent.pieces)
+        # Upload slots go to the interested peers which send us the most, or take the most from us while seeding,
+        # plus one peer picked at random so new peers get a chance to show their rate
+        self.upload_slots = upload_slots
+        self.optimistic_peer: Peer = None
+        self.last_choke = time.monotonic()
+        self.last_optimistic_unchoke = 0
+        # Unlimited levels are passed as None
+        self.upload_buckets = [bucket for bucket in upload_buckets or [] if bucket]
+        self.download_buckets = [bucket for bucket in download_buckets or [] if bucket]
+        self.peer_upload_rate = peer_upload_rate
+        self.peer_download_rate = peer_download_rate
+        # Peers waiting for a bandwidth limit to refill before uploading to or reading from them resumes
+        self.throttled_peers: set[Peer] = set()
+        # Peers with messages queued during the current pass of the event loop
+        self.pending_writes: set[Peer] = set()
+
+        # Work submitted by other threads, run on the event loop thread after the wakeup socket is written to
+        self.pending = collections.deque()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, None)
+
+        self.handlers = {
+            message.CHOKE_ID: self.handle_choke,
+            message.UNCHOKE_ID: self.handle_unchoke,
+            message.INTERESTED_ID: self.handle_interested,
+            message.NOT_INTERESTED_ID: self.handle_not_interested,
+            message.HAVE_ID: self.handle_have,
+            message.BITFIELD_ID: self.handle_bitfield,
+            message.REQUEST_ID: self.handle_request,
+            message.PIECE_ID: self.handle_piece,
+            message.CANCEL_ID: self.handle_cancel
+        }
+
+
+    """Run callback on the event loop thread, safe to call from any thread"""
+    def submit(self, callback, *args):
+        self.pending.append((callback, args))
+        try:
+            self.wakeup_sender.send(b'\x00')
+        except (BlockingIOError, InterruptedError):
+            # Wakeup socket is full, the loop is already going to wake up
+            pass
+
+
+    """Accept incoming connections on a listening socket, must be called before run()"""
+    def listen(self, listener: socket.socket):
+        self.listener = listener
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, self.listener)
+
+
+    def accept_peers(self):
+        while True:
+            try:
+                peer_socket, (peer_address, peer_port) = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Failed to accept connection request: {e}", file=sys.stderr)
+                return
+
+            peer = Peer(peer_address, peer_port, sock=peer_socket)
+            peer.connected = True
+
+            if DEBUG_MODE:
+                print(f"Accepted connection from: {peer.address, peer.port}")
+
+            self.register_peer(peer)
+
+
+    """Hand a connected peer which completed its handshake to the event loop"""
+    def add_peer(self, peer: Peer):
+        self.submit(self.register_peer, peer)
+
+
+    def register_peer(self, peer: Peer):
+        if not peer.connected or peer in self.peers:
+            return
+
+        peer.set_nonblocking()
+        peer.bitfield = BitArray(len(self.torrent.pieces))
+        peer.upload_buckets = self.upload_buckets + [bucket for bucket in [rate_limit.create_bandwidth_bucket(self.peer_upload_rate)] if bucket]
+        peer.download_buckets = self.download_buckets + [bucket for bucket in [rate_limit.create_bandwidth_bucket(self.peer_download_rate)] if bucket]
+        self.selector.register(peer.socket, selectors.EVENT_READ, peer)
+        self.peers.add(peer)
+
+        # Incoming peer, wait for its handshake before sending anything
+        if not peer.completed_handshake:
+            return
+
+        self.start_peer(peer)
+
+
+    """First messages to a peer once the handshake is done"""
+    def start_peer(self, peer: Peer):
+        # Interest is declared once the peer's Bitfield or Have messages show it has something we need
+        if self.torrent.bitfield.any(True):
+            peer.queue_message(message.Bitfield(self.torrent.bitfield))
+
+        self.schedule_write(peer)
+
+
+    def remove_peer(self, peer: Peer):
+        if peer not in self.peers:
+            return
+
+        self.peers.discard(peer)
+        self.throttled_peers.discard(peer)
+        self.pending_writes.discard(peer)
+        if peer is self.optimistic_peer:
+            self.optimistic_peer = None
+        self.selector.unregister(peer.socket)
+        self.cancel_requests(peer)
+        self.picker.remove_peer_pieces(peer.bitfield)
+        peer.disconnect()
+
+        if DEBUG_MODE:
+            print(f"Disconnected from {peer.peer_id, peer.address, peer.port}")
+
+        if self.on_disconnect:
+            self.on_disconnect(peer)
+
+
+    def run(self):
+        self.running = True
+
+        while self.running:
+            timeout = TICK_INTERVAL
+            if self.throttled_peers:
+                timeout = util.clamp(self.next_resume() - time.monotonic(), 0, TICK_INTERVAL)
+
+            for key, events in self.selector.select(timeout):
+                peer: Peer = key.data
+
+                if peer is None:
+                    self.run_pending()
+                    continue
+
+                if peer is self.listener:
+                    self.accept_peers()
+                    continue
+
+                if events & selectors.EVENT_READ:
+                    self.read_peer(peer)
+                if events & selectors.EVENT_WRITE and peer in self.peers:
+                    self.write_peer(peer)
+
+            if self.throttled_peers:
+                self.resume_peers()
+
+            if time.time() - self.last_tick >= TICK_INTERVAL:
+                self.tick()
+
+            self.flush_writes()
+
+        for peer in list(self.peers):
+            self.remove_peer(peer)
+
+
+    def run_pending(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while self.pending:
+            callback, args = self.pending.popleft()
+            callback(*args)
+
+
+    def read_peer(self, peer: Peer):
+        if not peer.receive():
+            self.remove_peer(peer)
+            return
+
+        if not peer.completed_handshake and not self.receive_handshake(peer):
+            return
+
+        frames = peer.take_messages()
+        if frames is None:
+            print(f"Message from {peer.address}:{peer.port} is too long", file=sys.stderr)
+            self.remove_peer(peer)
+            return
+
+        if peer.download_buckets:
+            self.account_download(peer, sum(len(frame) for frame in frames))
+
+        for frame in frames:
+            try:
+                msg = message.decode(frame)
+            except Exception as e:
+                print(f"Malformed message from {peer.address}:{peer.port}: {e}", file=sys.stderr)
+                self.remove_peer(peer)
+                return
+
+            # Keep-alives and unknown messages only refresh the peer's last_received time
+            if handler := self.handlers.get(getattr(msg, "message_id", None)):
+                handler(peer, msg)
+
+            if peer not in self.peers:
+                return
+
+        # Sent at the end of this pass together with whatever other peers' messages queue for this one,
+        # instead of waiting for the next writable event
+        self.schedule_write(peer)
+
+
+    """
+    Answer the handshake of an incoming peer
+    Returns False while the handshake is incomplete, or when the peer was rejected
+    """
+    def receive_handshake(self, peer: Peer):
+        raw_handshake = peer.take_handshake()
+        if raw_handshake is None:
+            return False
+
+        try:
+            handshake = message.Handshake.from_bytes(raw_handshake)
+        except Exception as e:
+            print(f"Malformed handshake from {peer.address}:{peer.port}: {e}", file=sys.stderr)
+            self.remove_peer(peer)
+            return False
+
+        if not handshake.validate(self.torrent.info_hash, self.peer_id):
+            self.remove_peer(peer)
+            return False
+
+        peer.peer_id = handshake.peer_id
+        if self.on_handshake and not self.on_handshake(peer):
+            self.remove_peer(peer)
+            return False
+
+        peer.queue_message(message.Handshake(self.torrent.info_hash, self.peer_id))
+        peer.completed_handshake = True
+
+        if DEBUG_MODE:
+            print(f"Completed handshake with {peer.peer_id, peer.address, peer.port}")
+
+        self.start_peer(peer)
+        return True
+
+
+    """Write the peer's queued messages at the end of the current pass of the event loop, in as few system calls as possible"""
+    def schedule_write(self, peer: Peer):
+        self.pending_writes.add(peer)
+
+
+    def flush_writes(self):
+        while self.pending_writes:
+            peer = self.pending_writes.pop()
+            if peer in self.peers:
+                self.write_peer(peer)
+
+
+    def write_peer(self, peer: Peer):
+        self.fill_uploads(peer)
+
+        if not peer.flush():
+            self.remove_peer(peer)
+            return
+
+        # Only wait for the socket to become writable while there is something left to send,
+        # and for it to become readable while no download limit is exceeded
+        events = 0
+        if peer.download_resume is None:
+            events |= selectors.EVENT_READ
+        if peer.has_queued_data() or (peer.upload_queue and peer.upload_resume is None):
+            events |= selectors.EVENT_WRITE
+
+        if self.selector.get_key(peer.socket).events != events:
+            self.selector.modify(peer.socket, events, peer)
+
+
+    """Keep-alives and idle timeouts, run about every TICK_INTERVAL seconds"""
+    def tick(self):
+        now = time.time()
+        self.last_tick = now
+        monotonic_now = time.monotonic()
+
+        new_rtt_window = monotonic_now - self.last_rtt_window >= RTT_WINDOW
+        if new_rtt_window:
+            self.last_rtt_window = monotonic_now
+
+        for peer in list(self.peers):
+            peer.download_meter.update(monotonic_now)
+            peer.upload_meter.update(monotonic_now)
+            if new_rtt_window:
+                peer.min_rtt, peer.window_min_rtt = peer.window_min_rtt, None
+            self.update_request_depth(peer)
+            self.expire_requests(peer, monotonic_now)
+
+            if not peer.completed_handshake and now - peer.last_received > HANDSHAKE_TIMEOUT:
+                self.remove_peer(peer)
+            elif now - peer.last_received > PEER_TIMEOUT:
+                self.remove_peer(peer)
+            elif now - peer.last_sent > KEEP_ALIVE_INTERVAL and not peer.has_queued_data():
+                peer.queue_message(message.KeepAlive())
+                self.schedule_write(peer)
+
+        if monotonic_now - self.last_choke >= CHOKE_INTERVAL:
+            self.rechoke(monotonic_now)
+
+
+    """
+    Choking round, run every CHOKE_INTERVAL seconds
+    The interested peers with the best rate keep the regular upload slots, and every OPTIMISTIC_UNCHOKE_INTERVAL
+    seconds the optimistic slot moves to another choked peer. Everyone else is choked
+    """
+    def rechoke(self, now: float):
+        self.last_choke = now
+        interested_peers = [peer for peer in self.peers if peer.completed_handshake and peer.state.peer_interested]
+
+        # Peers which upload to us are rewarded while downloading, once complete the fastest downloaders are served
+        if self.torrent.is_complete():
+            interested_peers.sort(key=lambda peer: peer.upload_meter.rate, reverse=True)
+        else:
+            interested_peers.sort(key=lambda peer: peer.download_meter.rate, reverse=True)
+
+        unchoked_peers = set(interested_peers[:max(0, self.upload_slots - 1)])
+
+        if self.optimistic_peer not in interested_peers or now - self.last_optimistic_unchoke >= OPTIMISTIC_UNCHOKE_INTERVAL:
+            candidates = [peer for peer in interested_peers if peer not in unchoked_peers]
+            self.optimistic_peer = random.choice(candidates) if candidates else None
+            self.last_optimistic_unchoke = now
+
+        if self.optimistic_peer is not None:
+            unchoked_peers.add(self.optimistic_peer)
+
+        for peer in list(self.peers):
+            if peer.completed_handshake:
+                self.set_choking(peer, peer not in unchoked_peers)
+
+
+    def set_choking(self, peer: Peer, choking: bool):
+        if choking == peer.state.am_choking:
+            return
+
+        peer.state.am_choking = choking
+        if choking:
+            # Choking drops every request of the peer which was not answered yet
+            peer.upload_queue.clear()
+            peer.queue_message(message.Choke())
+        else:
+            peer.queue_message(message.Unchoke())
+
+        self.schedule_write(peer)
+
+
+    def handle_choke(self, peer: Peer, msg: message.Choke):
+        peer.state.peer_choking = True
+        # A choking peer drops every request it has not answered yet
+        self.cancel_requests(peer)
+
+
+    def handle_unchoke(self, peer: Peer, msg: message.Unchoke):
+        peer.state.peer_choking = False
+        self.request_blocks(peer)
+
+
+    def handle_interested(self, peer: Peer, msg: message.Interested):
+        peer.state.peer_interested = True
+        self.fill_upload_slots()
+
+
+    def handle_not_interested(self, peer: Peer, msg: message.NotInterested):
+        peer.state.peer_interested = False
+        self.fill_upload_slots()
+
+
+    """Hand slots which are free right away to choked interested peers, instead of waiting for the next choking round"""
+    def fill_upload_slots(self):
+        # Peers which lost interest do not hold on to their slot
+        unchoked_count = sum(1 for peer in self.peers if not peer.state.am_choking and peer.state.peer_interested)
+
+        for peer in list(self.peers):
+            if unchoked_count >= self.upload_slots:
+                return
+
+            if peer.completed_handshake and peer.state.am_choking and peer.state.peer_interested:
+                self.set_choking(peer, False)
+                unchoked_count += 1
+
+
+    def handle_have(self, peer: Peer, msg: message.Have):
+        if not 0 <= msg.piece_index < len(self.torrent.pieces) or peer.bitfield[msg.piece_index]:
+            return
+
+        peer.bitfield.set(value=1, pos=msg.piece_index)
+        self.picker.add_piece(msg.piece_index)
+
+        if not self.torrent.pieces[msg.piece_index].verified:
+            self.update_interest(peer)
+            self.request_blocks(peer)
+
+
+    def handle_bitfield(self, peer: Peer, msg: message.Bitfield):
+        piece_count = len(self.torrent.pieces)
+
+        # Padded to whole bytes
+        if len(msg.bifield) != math.ceil(piece_count / 8) * 8:
+            print(f"Bitfield from {peer.address}:{peer.port} has the wrong length", file=sys.stderr)
+            self.remove_peer(peer)
+            return
+
+        self.picker.remove_peer_pieces(peer.bitfield)
+        peer.bitfield = msg.bifield[:piece_count]
+        self.picker.add_peer_pieces(peer.bitfield)
+
+        self.update_interest(peer)
+        self.request_blocks(peer)
+
+
+    """Tell the peer whether it has any piece we are still missing, when that changed"""
+    def update_interest(self, peer: Peer):
+        interested = (peer.bitfield & ~self.torrent.bitfield).any(True)
+        if interested == peer.state.am_interested:
+            return
+
+        peer.state.am_interested = interested
+        peer.queue_message(message.Interested() if interested else message.NotInterested())
+
+
+    """Queue the requested block, it is sent once the peer's send buffer has room for it"""
+    def handle_request(self, peer: Peer, msg: message.Request):
+        # Requests from choked peers are dropped, they re-request after being unchoked
+        if peer.state.am_choking or len(peer.upload_queue) >= MAX_UPLOAD_QUEUE:
+            return
+
+        if not 0 <= msg.piece_index < len(self.torrent.pieces):
+            return
+
+        piece: Piece = self.torrent.pieces[msg.piece_index]
+        block_index, block_offset = divmod(msg.block_offset, BLOCK_SIZE)
+        if not piece.verified or block_offset or not 0 <= block_index < piece.block_count:
+            return
+
+        if msg.piece_length != piece.blocks[block_index].block_size:
+            return
+
+        peer.upload_queue.append((msg.piece_index, block_index))
+
+
+    """Drop a queued upload the peer no longer wants, blocks already in the send queue are sent anyway"""
+    def handle_cancel(self, peer: Peer, msg: message.Cancel):
+        block_index, block_offset = divmod(msg.block_offset, BLOCK_SIZE)
+        if block_offset:
+            return
+
+        try:
+            peer.upload_queue.remove((msg.piece_index, block_index))
+        except ValueError:
+            pass
+
+
+    """
+    Move queued uploads into the send queue while it is below the low watermark
+    Each Piece message is let through by the upload limits as a whole, once they hold enough bytes for it
+    """
+    def fill_uploads(self, peer: Peer):
+        while peer.upload_queue and peer.send_queue_length < SEND_BUFFER_LOW_WATERMARK and peer.upload_resume is None:
+            piece_index, block_index = peer.upload_queue[0]
+            piece: Piece = self.torrent.pieces[piece_index]
+            block: Block = piece.blocks[block_index]
+            msg = message.Piece(block.block_size, piece_index, block_index, block.data)
+
+            if peer.upload_buckets:
+                delay = rate_limit.bandwidth_delay(peer.upload_buckets, msg.message_length)
+                if delay > 0:
+                    self.throttle(peer, upload_delay=delay)
+                    return
+
+                rate_limit.consume_bandwidth(peer.upload_buckets, msg.message_length)
+
+            peer.upload_queue.popleft()
+            peer.queue_piece(msg, self.get_file_segment(piece, block))
+            peer.upload_meter.add(block.block_size)
+
+
+    """Count messages read from the peer against the download limits, reading pauses while any of them is in debt"""
+    def account_download(self, peer: Peer, message_bytes: int):
+        delay = rate_limit.consume_bandwidth(peer.download_buckets, message_bytes)
+        if delay > 0:
+            self.throttle(peer, download_delay=delay)
+
+
+    def throttle(self, peer: Peer, upload_delay: float = None, download_delay: float = None):
+        now = time.monotonic()
+
+        if upload_delay is not None:
+            peer.upload_resume = now + upload_delay
+        if download_delay is not None:
+            peer.download_resume = now + download_delay
+
+        self.throttled_peers.add(peer)
+
+
+    def next_resume(self):
+        return min(
+            resume_time
+            for peer in self.throttled_peers
+            for resume_time in (peer.upload_resume, peer.download_resume)
+            if resume_time is not None
+        )
+
+
+    """Lift the limits of throttled peers whose wait is over, and send or read what was held back"""
+    def resume_peers(self):
+        now = time.monotonic()
+
+        for peer in list(self.throttled_peers):
+            resumed = False
+
+            if peer.upload_resume is not None and now >= peer.upload_resume:
+                peer.upload_resume = None
+                resumed = True
+            if peer.download_resume is not None and now >= peer.download_resume:
+                peer.download_resume = None
+                resumed = True
+
+            if not resumed:
+                continue
+
+            if peer.upload_resume is None and peer.download_resume is None:
+                self.throttled_peers.discard(peer)
+
+            self.schedule_write(peer)
+
+
+    """
+    Where a block is stored on disk, when it can be sent straight from the file
+    Only pieces read from a single file torrent qualify, downloaded pieces are written elsewhere and sent from memory
+    """
+    def get_file_segment(self, piece: Piece, block: Block) -> FileSegment:
+        if self.torrent.file_count != 1 or not self.torrent.files or piece.downloaded:
+            return None
+
+        file_offset = piece.index * self.torrent.piece_length + block.index * BLOCK_SIZE
+        return FileSegment(self.torrent.files[0].fileno(), file_offset, block.block_size)
+
+
+    def handle_piece(self, peer: Peer, msg: message.Piece):
+        request = (msg.piece_index, msg.block_index)
+        peer.download_meter.add(len(msg.block_data))
+
+        if (requested_time := peer.requests.pop(request, None)) is not None:
+            self.add_rtt_sample(peer, time.monotonic() - requested_time)
+
+        # Endgame duplicates of this block are no longer needed
+        for other_peer in self.picker.block_received(request, peer):
+            other_peer.requests.pop(request, None)
+            other_peer.queue_message(message.Cancel(msg.piece_index, msg.block_index * BLOCK_SIZE, len(msg.block_data)))
+            self.schedule_write(other_peer)
+
+        if not 0 <= msg.piece_index < len(self.torrent.pieces):
+            return
+
+        piece: Piece = self.torrent.pieces[msg.piece_index]
+        if piece.add_block(msg.block_index, msg.block_data):
+            self.complete_piece(piece)
+
+        self.request_blocks(peer)
+
+
+    def complete_piece(self, piece: Piece):
+        self.torrent.write_piece(piece, self.save_path)
+        self.torrent.bitfield.set(value=1, pos=piece.index)
+        self.picker.piece_completed(piece.index)
+
+        if DEBUG_MODE:
+            print(f"Downloaded piece {piece.index}: {self.torrent}")
+
+        # Peers which do not have the piece yet can now download it from us
+        for peer in list(self.peers):
+            if not peer.bitfield[piece.index]:
+                peer.queue_message(message.Have(piece.index))
+            self.update_interest(peer)
+            self.schedule_write(peer)
+
+        if DEBUG_MODE and self.torrent.is_complete():
+            print("Download complete")
+
+
+    def add_rtt_sample(self, peer: Peer, rtt: float):
+        if peer.window_min_rtt is None or rtt < peer.window_min_rtt:
+            peer.window_min_rtt = rtt
+        if peer.min_rtt is None or rtt < peer.min_rtt:
+            peer.min_rtt = rtt
+
+
+    """
+    Size the request pipeline to the peer's bandwidth-delay product, in blocks
+    Fast or distant peers get enough requests in flight to stay busy for a whole round trip
+    """
+    def update_request_depth(self, peer: Peer):
+        if peer.min_rtt is None:
+            return
+
+        bdp_blocks = peer.download_meter.rate * peer.min_rtt / BLOCK_SIZE
+        peer.request_depth = util.clamp(math.ceil(REQUEST_DEPTH_BDP_FACTOR * bdp_blocks), MIN_REQUEST_DEPTH, MAX_REQUEST_DEPTH)
+
+
+    """Give up on requests the peer has not answered, so the blocks can be requested again"""
+    def expire_requests(self, peer: Peer, now: float):
+        expired = [request for request, requested_time in peer.requests.items() if now - requested_time > REQUEST_TIMEOUT]
+
+        for request in expired:
+            del peer.requests[request]
+            self.picker.release(request, peer)
+
+        if expired:
+            self.request_blocks(peer)
+            self.schedule_write(peer)
+
+
+    """Keep as many blocks requested from a peer which is not choking us as its request depth allows"""
+    def request_blocks(self, peer: Peer):
+        if peer.state.peer_choking:
+            return
+
+        request_depth = peer.request_depth or INITIAL_REQUEST_DEPTH
+        requested_time = time.monotonic()
+
+        for piece, block in self.picker.pick(peer, request_depth - len(peer.requests)):
+            peer.queue_message(message.Request(piece.index, block.index * BLOCK_SIZE, block.block_size))
+            peer.requests[(piece.index, block.index)] = requested_time
+
+
+    """Forget the outstanding requests of a peer so the blocks are requested from someone else"""
+    def cancel_requests(self, peer: Peer):
+        for request in peer.requests:
+            self.picker.release(request, peer)
+
+        peer.requests.clear()
+
+
+    """Stop the event loop, safe to call from any thread"""
+    def stop(self):
+        self.running = False
+        self.submit(lambda: None)
+
+
+    def __del__(self):
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
@@ -18,6 +18,7 @@ HAVE_ID = 4
 BITFIELD_ID = 5
 REQUEST_ID = 6
 PIECE_ID = 7
+CANCEL_ID = 8
 
 class Message():
     def __init__(self, message_length: int):
@@ -90,9 +91,9 @@ class KeepAlive(Message):
 
     @classmethod
     def from_bytes(cls, raw_message: bytes):
-        message = struct.unpack("!I", raw_message[:PEER_WIRE_PREFIX_LENGTH])
+        payload_length = struct.unpack("!I", raw_message[:PEER_WIRE_PREFIX_LENGTH])[0]
 
-        if message != 0:
+        if payload_length != 0:
             raise Exception("Malformed KeepAlive message")
 
         return KeepAlive()
@@ -103,11 +104,11 @@ class Bitfield(Message):
 
     def __init__(self, bifield: BitArray):
         super().__init__(PEER_WIRE_MESSAGE_LENGTH)
-        self.payload_length = 1
         self.message_id = BITFIELD_ID
         self.bifield = bifield
         self.raw_bitfield = self.bifield.tobytes()
-        self.PAYLOAD_LENGTH = len(self.bifield)
+        self.PAYLOAD_LENGTH = len(self.raw_bitfield)
+        self.payload_length = PEER_WIRE_ID_LENGTH + self.PAYLOAD_LENGTH
         self.message_length = PEER_WIRE_MESSAGE_LENGTH + self.PAYLOAD_LENGTH
 
 
@@ -125,7 +126,8 @@ class Bitfield(Message):
         if message_id != BITFIELD_ID:
             raise Exception("Malformed Bitfield message")
         
-        raw_bitfield = struct.unpack("!{}s".format(cls.PAYLOAD_LENGTH), raw_message[PEER_WIRE_MESSAGE_LENGTH:PEER_WIRE_MESSAGE_LENGTH + cls.PAYLOAD_LENGTH])
+        bitfield_length = payload_length - PEER_WIRE_ID_LENGTH
+        raw_bitfield = struct.unpack("!{}s".format(bitfield_length), raw_message[PEER_WIRE_MESSAGE_LENGTH:PEER_WIRE_MESSAGE_LENGTH + bitfield_length])[0]
         bitfield = BitArray(bytes=raw_bitfield)
 
         return Bitfield(bitfield)
@@ -220,7 +222,7 @@ class Have(Message):
 
     def __init__(self, piece_index: int):
         super().__init__(PEER_WIRE_MESSAGE_LENGTH + self.PAYLOAD_LENGTH)
-        self.payload_length = 1
+        self.payload_length = PEER_WIRE_ID_LENGTH + self.PAYLOAD_LENGTH
         self.message_id = HAVE_ID
         self.piece_index = piece_index
 
@@ -239,7 +241,7 @@ class Have(Message):
         if message_id != HAVE_ID:
             raise Exception("Malformed Have message")
 
-        piece_index = struct.unpack("!I", raw_message[PEER_WIRE_MESSAGE_LENGTH:PEER_WIRE_MESSAGE_LENGTH + cls.PAYLOAD_LENGTH])
+        piece_index = struct.unpack("!I", raw_message[PEER_WIRE_MESSAGE_LENGTH:PEER_WIRE_MESSAGE_LENGTH + cls.PAYLOAD_LENGTH])[0]
 
         return Have(piece_index)
 
@@ -249,7 +251,7 @@ class Request(Message):
 
     def __init__(self, piece_index: int, block_offset: int, piece_length: int):
         super().__init__(PEER_WIRE_MESSAGE_LENGTH + self.PAYLOAD_LENGTH)
-        self.payload_length = 1
+        self.payload_length = PEER_WIRE_ID_LENGTH + self.PAYLOAD_LENGTH
         self.message_id = REQUEST_ID
         self.piece_index = piece_index
         self.block_offset = block_offset
@@ -269,7 +271,7 @@ class Request(Message):
     def from_bytes(cls, raw_message: bytes):
         payload_length, message_id = struct.unpack("!IB", raw_message[:PEER_WIRE_MESSAGE_LENGTH])
 
-        if payload_length != 1:
+        if payload_length != PEER_WIRE_ID_LENGTH + cls.PAYLOAD_LENGTH:
             raise Exception("Malformed Request message")
 
         if message_id != REQUEST_ID:
@@ -285,23 +287,24 @@ class Piece(Message):
 
     def __init__(self, block_length: int, piece_index: int, block_index: int, block_data: bytes):
         super().__init__(PEER_WIRE_MESSAGE_LENGTH)
-        self.payload_length = 1
         self.message_id = PIECE_ID
         self.block_length = block_length
         self.piece_index = piece_index
         self.block_index = block_index
         self.block_data = block_data
-        self.PAYLOAD_LENGTH = 4*3 + len(self.block_data)
+        self.PAYLOAD_LENGTH = 4*2 + len(self.block_data)
+        self.payload_length = PEER_WIRE_ID_LENGTH + self.PAYLOAD_LENGTH
         self.message_length = PEER_WIRE_MESSAGE_LENGTH + self.PAYLOAD_LENGTH
 
 
     def to_bytes(self):
-        message = struct.pack("!IB", self.payload_length, self.message_id)
-        message += struct.pack("!I", self.piece_index)
-        message += struct.pack("!I", self.block_index)
-        message += struct.pack("!{}s".format(self.block_length), self.block_data)
+        # block_data may be a view of the piece, join accepts it without copying it first
+        return b''.join((self.header(), self.block_data))
 
-        return message
+
+    """Everything before the block, so the block itself can be sent without being copied into the message"""
+    def header(self):
+        return struct.pack("!IBII", self.payload_length, self.message_id, self.piece_index, self.block_index)
 
 
     @classmethod
@@ -312,11 +315,64 @@ class Piece(Message):
             raise Exception("Malformed Piece message")
         
         block_length = len(raw_message) - 4*3 - 1
-        piece_index, block_index = struct.unpack("!II", raw_message[PEER_WIRE_MESSAGE_LENGTH:PEER_WIRE_MESSAGE_LENGTH + 4*2])
-        block_data = struct.unpack("!{}s".format(block_length), raw_message[PEER_WIRE_MESSAGE_LENGTH + 4*2:PEER_WIRE_MESSAGE_LENGTH + 4*2 + block_length])[0]
+        piece_index, block_index = struct.unpack_from("!II", raw_message, PEER_WIRE_MESSAGE_LENGTH)
+        # A view when raw_message is one, the block is copied once, into piece storage
+        block_data = raw_message[PEER_WIRE_MESSAGE_LENGTH + 4*2:]
 
         return Piece(block_length, piece_index, block_index, block_data)
 
 
+class Cancel(Message):
+    PAYLOAD_LENGTH = 4*3
+
+    def __init__(self, piece_index: int, block_offset: int, piece_length: int):
+        super().__init__(PEER_WIRE_MESSAGE_LENGTH + self.PAYLOAD_LENGTH)
+        self.payload_length = PEER_WIRE_ID_LENGTH + self.PAYLOAD_LENGTH
+        self.message_id = CANCEL_ID
+        self.piece_index = piece_index
+        self.block_offset = block_offset
+        self.piece_length = piece_length
+
+
+    def to_bytes(self):
+        return struct.pack("!IBIII", self.payload_length, self.message_id, self.piece_index, self.block_offset, self.piece_length)
+
+
+    @classmethod
+    def from_bytes(cls, raw_message: bytes):
+        payload_length, message_id = struct.unpack_from("!IB", raw_message)
+
+        if payload_length != PEER_WIRE_ID_LENGTH + cls.PAYLOAD_LENGTH or message_id != CANCEL_ID:
+            raise Exception("Malformed Cancel message")
+
+        piece_index, block_offset, piece_length = struct.unpack_from("!III", raw_message, PEER_WIRE_MESSAGE_LENGTH)
+
+        return Cancel(piece_index, block_offset, piece_length)
+
+
+MESSAGE_TYPES = {
+    CHOKE_ID: Choke,
+    UNCHOKE_ID: Unchoke,
+    INTERESTED_ID: Interested,
+    NOT_INTERESTED_ID: NotInterested,
+    HAVE_ID: Have,
+    BITFIELD_ID: Bitfield,
+    REQUEST_ID: Request,
+    PIECE_ID: Piece,
+    CANCEL_ID: Cancel
+}
+
+
+"""
+Parse one complete frame, the 4 byte length prefix followed by that many bytes
+Returns None for message ids this client does not know, which are skipped
+"""
+def decode(raw_message: bytes) -> Message:
+    if len(raw_message) == PEER_WIRE_PREFIX_LENGTH:
+        return KeepAlive.from_bytes(raw_message)
 
+    message_type = MESSAGE_TYPES.get(raw_message[PEER_WIRE_PREFIX_LENGTH])
+    if message_type is None:
+        return None
 
+    return message_type.from_bytes(raw_message)
@@ -1,17 +1,47 @@
+from bitstring import BitArray
 import sys
 import peer_state
 import socket
 import message
-from piece import Piece
-from block import Block, BLOCK_SIZE
-import hashlib
+from block import BLOCK_SIZE
+from rate_limit import RateMeter, TokenBucket
+import collections
+import os
 import struct
-from torrent import Torrent
+import time
 
 # Maximum number of connections allowed by the socket
 MAX_PEER_REQUESTS = 20
 # Socket timeout
 KEEP_ALIVE_TIMEOUT = 10
+# Initial size of the receive buffer of a connection, a few Piece messages, grown when a longer message arrives
+RECEIVE_BUFFER_SIZE = 4 * BLOCK_SIZE
+# Larger messages are treated as a protocol error instead of growing the receive buffer for them
+MAX_MESSAGE_LENGTH = 2 ** 20
+# Most buffers passed to a single sendmsg call, well below IOV_MAX
+MAX_SEND_BUFFERS = 64
+# Neither is available on every platform (e.g. Windows), queued data is then sent one buffer at a time
+SENDFILE_SUPPORTED = hasattr(os, "sendfile")
+SENDMSG_SUPPORTED = hasattr(socket.socket, "sendmsg")
+# Tells the kernel more data follows, so a Piece header is not sent as its own small packet ahead of its block
+SEND_MORE_FLAG = getattr(socket, "MSG_MORE", 0)
+# Linux only, holds back partial packets while a send queue mixing buffers and file segments is written
+TCP_CORK_SUPPORTED = hasattr(socket, "TCP_CORK")
+
+
+# Part of an open file queued for sending, the kernel copies it to the socket without it passing through Python
+class FileSegment():
+    __slots__ = ("fd", "offset", "length")
+
+    def __init__(self, fd: int, offset: int, length: int):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+
+
+    def __len__(self):
+        return self.length
+
 
 class Peer():
     def __init__(self, address: str, port: int, peer_id: str = None, seeding: bool = False, sock: socket.socket = None):
@@ -23,68 +53,59 @@ class Peer():
         self.socket = sock if sock else socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.settimeout(KEEP_ALIVE_TIMEOUT)
 
-        self.state = peer_state.INITIAL
+        self.state = peer_state.INITIAL.copy()
         self.connected = False
         self.completed_handshake = False
 
+        # Allocated once the connection is handed to the event loop, see set_nonblocking() and engine.py
+        # Sockets read straight into this preallocated buffer, messages are handed out as views of it
+        # Bytes between receive_start and receive_end have been received but not taken out as messages yet
+        self.receive_buffer: bytearray = None
+        self.receive_view: memoryview = None
+        self.receive_start = 0
+        self.receive_end = 0
+        # Data waiting for the socket to accept it, bytes-like buffers (often views of piece data) and FileSegments
+        # Nothing is copied into a single send buffer, buffers are written together with sendmsg
+        self.send_queue: collections.deque = collections.deque()
+        # Total number of bytes in the send queue, and how many of its entries are FileSegments
+        self.send_queue_length = 0
+        self.send_queue_segments = 0
+        # Pieces the peer has, from its Bitfield and Have messages
+        self.bitfield: BitArray = None
+        # Blocks requested from this peer which have not arrived yet, (piece index, block index) -> time requested
+        self.requests: dict[tuple[int, int], float] = {}
+        # Number of requests kept outstanding with this peer, adapted to its throughput and round trip time
+        self.request_depth = None
+        self.download_meter = RateMeter()
+        # Block data sent to this peer, used to rank peers for upload slots while seeding
+        self.upload_meter = RateMeter()
+        # Bandwidth limits (client, torrent and peer wide) messages to and from this peer are accounted in
+        self.upload_buckets: list[TokenBucket] = []
+        self.download_buckets: list[TokenBucket] = []
+        # Monotonic time at which uploading to or reading from the peer resumes after a limit was hit, None while not limited
+        self.upload_resume: float = None
+        self.download_resume: float = None
+        # Lowest time between a request and its block seen during the current and the previous window
+        # Queueing behind earlier requests only adds to a sample, so the minimum is closest to the real round trip
+        self.min_rtt: float = None
+        self.window_min_rtt: float = None
+        # Blocks this peer requested from us which have not been sent yet, (piece index, block index)
+        self.upload_queue: collections.deque[tuple[int, int]] = collections.deque()
+        self.last_received = time.time()
+        self.last_sent = time.time()
 
-    def send_block(self, piece: Piece, block_index: int):
-        if piece.blocks[block_index] is None:
-            return False
-        
-        block: Block = piece.blocks[block_index]
-        msg = message.Piece(block.block_size, piece.index, block_index, block.data)
-
-        if not self.send_data(msg.to_bytes()):
-            return None
-
-        return True
-
-
-    def recv_message(self, torrent: Torrent):
-        raw_header = self.receive_data(message.PEER_WIRE_MESSAGE_LENGTH)
-        if not raw_header:
-            return None
-
-        payload_length, message_id = struct.unpack("!IB", raw_header)
-
-        if message_id == message.CHOKE_ID:
-            pass
-        elif message_id == message.UNCHOKE_ID:
-            pass
-        elif message_id == message.INTERESTED_ID:
-            pass
-        elif message_id == message.NOT_INTERESTED_ID:
-            pass
-        elif message_id == message.HAVE_ID:
-            pass
-        elif message_id == message.BITFIELD_ID:
-            pass
-        elif message_id == message.REQUEST_ID:
-            pass
-        elif message_id == message.PIECE_ID:
-            self.recv_block(raw_header, torrent)
-
-
-    def recv_block(self, raw_header, torrent: Torrent):
-        print(f"Received block")
-
-        raw_data = self.receive_data(4*2 + BLOCK_SIZE) # TODO: Receive the real size of the block (last block will likely be less than BLOCK_SIZE)
-        if not raw_data:
-            return None
-
-        piece_index, block_index = struct.unpack("!II", raw_data[:4*2])
-        block_msg = message.Piece.from_bytes(raw_header + raw_data)
-        torrent.pieces[piece_index].blocks[block_index].data = block_msg.block_data
 
     """Send handshake before receive (for downloading peers)"""
     def initiate_handshake(self, info_hash: str, client_peer_id: str, expected_peer_id: str):
         if not self.send_handshake(info_hash, client_peer_id):
             return False
 
-        if not self.receive_handshake(info_hash, client_peer_id, expected_peer_id):
+        handshake = self.receive_handshake(info_hash, client_peer_id, expected_peer_id)
+        if not handshake:
             return False
 
+        # Peer ids are not known in advance when the tracker sent a compact peer list
+        self.peer_id = handshake.peer_id
         self.completed_handshake = True
         return True
 
@@ -137,29 +158,251 @@ class Peer():
     def receive_data(self, total_bytes: int):
         if not self.connected: return
 
-        raw_data = b''
+        # Filled in place, instead of concatenating every chunk into a new bytes object
+        raw_data = bytearray(total_bytes)
+        view = memoryview(raw_data)
         bytes_received = 0
-        bytes_remaining = total_bytes
 
         while (bytes_received < total_bytes):
             try:
-                chunk = self.socket.recv(bytes_remaining)
+                chunk_length = self.socket.recv_into(view[bytes_received:])
             except socket.timeout as e:
                 #print(f"Socket timeout, closing connection: {e}")
                 self.disconnect()
                 return None
             
-            chunk_length = len(chunk)
             if chunk_length == 0:
                 return None
 
-            raw_data += chunk
-            bytes_remaining -= chunk_length
             bytes_received += chunk_length
 
         return raw_data
 
 
+    """
+    Switch to non-blocking mode, after the handshake, when the connection is handed to the event loop
+    Nagle's algorithm is turned off, the event loop already batches messages and would only be delayed by it
+    """
+    def set_nonblocking(self):
+        self.socket.setblocking(False)
+
+        # Listening sockets and connections which never reach the event loop do without one
+        if self.receive_buffer is None:
+            self.receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+            self.receive_view = memoryview(self.receive_buffer)
+
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            print(f"Failed to disable Nagle's algorithm for {self.address}:{self.port}: {e}", file=sys.stderr)
+
+
+    def set_cork(self, corked: bool):
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(corked))
+        except OSError:
+            pass
+
+
+    """Read what the socket has available into the receive buffer, returns False when the connection was closed"""
+    def receive(self):
+        # Make room at the end once less than a block is left
+        if len(self.receive_buffer) - self.receive_end < BLOCK_SIZE:
+            self.compact_receive_buffer()
+
+        try:
+            bytes_received = self.socket.recv_into(self.receive_view[self.receive_end:])
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+
+        if not bytes_received:
+            return False
+
+        self.last_received = time.time()
+        self.receive_end += bytes_received
+        return True
+
+
+    """
+    Move the unread bytes, at most one partial message, to the front of the receive buffer
+    The buffer is only replaced by a larger one when a single message does not fit
+    """
+    def compact_receive_buffer(self):
+        unread_length = self.receive_end - self.receive_start
+
+        if self.receive_start == 0:
+            receive_buffer = bytearray(2 * len(self.receive_buffer))
+            receive_buffer[:unread_length] = self.receive_view[:unread_length]
+            self.receive_view.release()
+            self.receive_buffer = receive_buffer
+            self.receive_view = memoryview(receive_buffer)
+        else:
+            self.receive_view[:unread_length] = self.receive_view[self.receive_start:self.receive_end]
+
+        self.receive_start = 0
+        self.receive_end = unread_length
+
+
+    """Remove the handshake from the front of the receive buffer, None until all of it has arrived"""
+    def take_handshake(self) -> bytes:
+        if self.receive_end - self.receive_start < message.HANDSHAKE_MESSAGE_LENGTH:
+            return None
+
+        handshake_end = self.receive_start + message.HANDSHAKE_MESSAGE_LENGTH
+        raw_handshake = bytes(self.receive_view[self.receive_start:handshake_end])
+        self.receive_start = handshake_end
+        return raw_handshake
+
+
+    """
+    Remove every complete message from the receive buffer, a partial message stays in the buffer
+    Each message is returned as a view of one frame including its length prefix, without copying it
+    The views are only valid until the next call to receive(), which may overwrite them
+    Returns None when the peer announced a message longer than MAX_MESSAGE_LENGTH
+    """
+    def take_messages(self) -> list[memoryview]:
+        frames = []
+        offset = self.receive_start
+
+        while self.receive_end - offset >= message.PEER_WIRE_PREFIX_LENGTH:
+            payload_length = struct.unpack_from("!I", self.receive_buffer, offset)[0]
+            if payload_length > MAX_MESSAGE_LENGTH:
+                return None
+
+            frame_end = offset + message.PEER_WIRE_PREFIX_LENGTH + payload_length
+            if frame_end > self.receive_end:
+                break
+
+            frames.append(self.receive_view[offset:frame_end])
+            offset = frame_end
+
+        # Start over at the front of the buffer whenever everything was taken, which avoids most compactions
+        if offset == self.receive_end:
+            self.receive_start = self.receive_end = 0
+        else:
+            self.receive_start = offset
+
+        return frames
+
+
+    """Add a message to the send queue, it is written once the socket is writable"""
+    def queue_message(self, msg: message.Message):
+        self.queue_data(msg.to_bytes())
+
+
+    def queue_data(self, data):
+        if len(data):
+            self.send_queue.append(data)
+            self.send_queue_length += len(data)
+            if isinstance(data, FileSegment):
+                self.send_queue_segments += 1
+
+
+    """
+    Queue a Piece message without copying its block, the header and the block are written together
+    When file_segment is given the block is sent from disk with sendfile instead of from memory
+    """
+    def queue_piece(self, msg: message.Piece, file_segment: FileSegment = None):
+        self.queue_data(msg.header())
+
+        if file_segment and SENDFILE_SUPPORTED:
+            self.queue_data(file_segment)
+        else:
+            self.queue_data(memoryview(msg.block_data))
+
+
+    def has_queued_data(self):
+        return self.send_queue_length > 0
+
+
+    """
+    Write as much of the send queue as the socket accepts, returns False when the connection was closed
+    Runs of buffers go out in one sendmsg call. A queue which also holds file segments takes several calls,
+    the socket is corked meanwhile so the calls still fill whole packets
+    """
+    def flush(self):
+        corked = TCP_CORK_SUPPORTED and self.send_queue_segments > 0 and len(self.send_queue) > 1
+        if corked:
+            self.set_cork(True)
+
+        try:
+            return self.send_queued_data(corked)
+        finally:
+            if corked:
+                self.set_cork(False)
+
+
+    def send_queued_data(self, corked: bool):
+        while self.send_queue:
+            head = self.send_queue[0]
+
+            try:
+                if isinstance(head, FileSegment):
+                    bytes_requested = head.length
+                    bytes_sent = os.sendfile(self.socket.fileno(), head.fd, head.offset, head.length)
+                    # File is shorter than the segment
+                    if bytes_sent == 0:
+                        return False
+                elif SENDMSG_SUPPORTED:
+                    buffers = self.take_send_buffers()
+                    bytes_requested = sum(len(buffer) for buffer in buffers)
+                    # Followed by a block sent from a file
+                    more = len(buffers) < len(self.send_queue) and isinstance(self.send_queue[len(buffers)], FileSegment)
+                    bytes_sent = self.socket.sendmsg(buffers, [], SEND_MORE_FLAG if more and not corked else 0)
+                else:
+                    bytes_requested = len(head)
+                    bytes_sent = self.socket.send(head)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                return False
+
+            self.consume_send_queue(bytes_sent)
+            self.last_sent = time.time()
+
+            # The socket buffer is full, another call would only fail with EAGAIN
+            if bytes_sent < bytes_requested:
+                break
+
+        return True
+
+
+    """Buffers at the front of the send queue up to the next file segment, for one sendmsg call"""
+    def take_send_buffers(self) -> list:
+        buffers = []
+
+        for data in self.send_queue:
+            if isinstance(data, FileSegment) or len(buffers) == MAX_SEND_BUFFERS:
+                break
+            buffers.append(data)
+
+        return buffers
+
+
+    """Drop bytes_sent bytes from the front of the send queue, a partially sent entry keeps its remainder"""
+    def consume_send_queue(self, bytes_sent: int):
+        self.send_queue_length -= bytes_sent
+
+        while bytes_sent:
+            head = self.send_queue[0]
+            head_length = len(head)
+
+            if bytes_sent >= head_length:
+                self.send_queue.popleft()
+                bytes_sent -= head_length
+                if isinstance(head, FileSegment):
+                    self.send_queue_segments -= 1
+            elif isinstance(head, FileSegment):
+                head.offset += bytes_sent
+                head.length -= bytes_sent
+                bytes_sent = 0
+            else:
+                self.send_queue[0] = memoryview(head)[bytes_sent:]
+                bytes_sent = 0
+
+
     def start_listening(self):
         try:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -184,24 +427,6 @@ class Peer():
             return self.connected
 
 
-    def accept_connection(self):
-        peer = None
-        try:
-            peer_socket, _ = self.socket.accept()
-            if not peer_socket:
-                return None
-
-            peer_address, peer_port = peer_socket.getpeername()
-            peer = Peer(peer_address, peer_port, sock=peer_socket)
-            peer.connected = True
-
-        except Exception as e:
-            print(f"Failed to accept connection request: {e}", file=sys.stderr)
-            return None
-
-        return peer
-
-
     def disconnect(self):
         self.state = peer_state.NULL
         self.connected = False
@@ -6,6 +6,11 @@ class _PeerState():
         self.peer_interested = peer_interested
 
 
+    """States below are shared, each connection changes its own copy"""
+    def copy(self):
+        return _PeerState(self.am_choking, self.am_interested, self.peer_choking, self.peer_interested)
+
+
     def __eq__(self, peer_state: '_PeerState'): 
         if self.am_choking != peer_state.am_choking:
             return False
@@ -0,0 +1,152 @@
+from bitstring import BitArray
+from piece import Piece
+from block import Block, BlockState
+import random
+import time
+
+# Seconds between rebuilds of the rarest-first order, availability changes in between are picked up at the next one
+ORDER_REFRESH_INTERVAL = 0.5
+# Endgame starts once every missing block is requested and at most this many are still outstanding
+ENDGAME_THRESHOLD = 64
+
+# Chooses which blocks to request from a peer
+# Pieces are ranked by how many connected peers have them, rarest first, so rare pieces spread before their
+# last source leaves. Pieces which were already started are finished first to keep few pieces incomplete
+# In the endgame the last outstanding blocks are also requested from every other peer which has them,
+# so the download does not wait for the slowest peer, and the duplicates are cancelled once one copy arrives
+class PiecePicker():
+    def __init__(self, pieces: list[Piece]):
+        self.pieces = pieces
+        # Number of connected peers which have each piece
+        self.availability = [0] * len(pieces)
+        # Random rank of each piece, breaks ties between equally rare pieces differently on every client
+        self.tie_breakers = random.sample(range(len(pieces)), len(pieces))
+        # Indexes of the missing pieces, rarest first
+        self.order: list[int] = []
+        self.order_dirty = True
+        self.order_updated = 0
+        # Pieces with blocks requested or received which are not complete yet
+        self.partial_pieces: set[int] = set()
+        # Blocks requested from any peer, (piece index, block index) -> peers it was requested from
+        # There is only more than one peer per block in the endgame
+        self.requested: dict[tuple, list] = {}
+        # Number of blocks in flight for each piece
+        self.outstanding = [0] * len(pieces)
+
+
+    def add_peer_pieces(self, bitfield: BitArray):
+        for index in bitfield.findall([1]):
+            self.availability[index] += 1
+        self.order_dirty = True
+
+
+    def remove_peer_pieces(self, bitfield: BitArray):
+        for index in bitfield.findall([1]):
+            self.availability[index] -= 1
+        self.order_dirty = True
+
+
+    """A peer announced one more piece with a Have message"""
+    def add_piece(self, index: int):
+        self.availability[index] += 1
+        self.order_dirty = True
+
+
+    def piece_completed(self, index: int):
+        self.partial_pieces.discard(index)
+        self.order_dirty = True
+
+
+    def get_order(self):
+        now = time.monotonic()
+
+        if self.order_dirty and now - self.order_updated >= ORDER_REFRESH_INTERVAL:
+            missing_pieces = [piece.index for piece in self.pieces if not piece.verified]
+            self.order = sorted(missing_pieces, key=lambda index: (self.availability[index], self.tie_breakers[index]))
+            self.order_dirty = False
+            self.order_updated = now
+
+        return self.order
+
+
+    """
+    Choose up to count blocks the peer has which are neither downloaded nor requested yet, and mark them requested
+    Returns (piece, block) pairs
+    """
+    def pick(self, peer, count: int) -> list[tuple[Piece, Block]]:
+        picks = []
+        if count <= 0:
+            return picks
+
+        partial_pieces = sorted(self.partial_pieces, key=lambda index: (self.availability[index], self.tie_breakers[index]))
+
+        for candidates in (partial_pieces, self.get_order()):
+            for index in candidates:
+                piece = self.pieces[index]
+
+                # Every missing block of the piece is already on its way
+                if piece.verified or not peer.bitfield[index] or self.outstanding[index] >= piece.missing_blocks:
+                    continue
+
+                for block in piece.blocks:
+                    if block.state == BlockState.EMPTY and (index, block.index) not in self.requested:
+                        self.mark_requested(index, block.index, peer)
+                        picks.append((piece, block))
+
+                        if len(picks) == count:
+                            return picks
+
+        if self.in_endgame():
+            for (index, block_index), peers in self.requested.items():
+                if peer in peers or not peer.bitfield[index]:
+                    continue
+
+                peers.append(peer)
+                picks.append((self.pieces[index], self.pieces[index].blocks[block_index]))
+
+                if len(picks) == count:
+                    break
+
+        return picks
+
+
+    """Every missing block is requested, and only a few of them are still outstanding"""
+    def in_endgame(self):
+        if len(self.requested) > ENDGAME_THRESHOLD:
+            return False
+
+        return all(
+            self.outstanding[piece.index] >= piece.missing_blocks
+            for piece in self.pieces
+            if not piece.verified
+        )
+
+
+    def mark_requested(self, piece_index: int, block_index: int, peer):
+        self.requested[(piece_index, block_index)] = [peer]
+        self.outstanding[piece_index] += 1
+        self.partial_pieces.add(piece_index)
+
+
+    """Forget a request made to peer, after the request was abandoned"""
+    def release(self, request: tuple[int, int], peer):
+        peers = self.requested.get(request)
+        if not peers or peer not in peers:
+            return False
+
+        peers.remove(peer)
+        if not peers:
+            del self.requested[request]
+            self.outstanding[request[0]] -= 1
+
+        return True
+
+
+    """A requested block arrived from peer, returns the other peers it was requested from, which should be cancelled"""
+    def block_received(self, request: tuple[int, int], peer) -> list:
+        peers = self.requested.pop(request, None)
+        if peers is None:
+            return []
+
+        self.outstanding[request[0]] -= 1
+        return [other_peer for other_peer in peers if other_peer is not peer]
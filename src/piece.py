@@ -12,10 +12,20 @@ class Piece:
         self.downloaded = False
         self.length = None
         self.data = None
-
-
+        # Blocks of a piece being downloaded are written here
+        self.buffer: bytearray = None
+        self.block_count = 0
+        self.blocks: list[Block] = []
+        # Number of blocks which have not been received yet, while downloading
+        self.missing_blocks = 0
+
+
+    """
+    Create a piece for every hash, indexed by piece number
+    Pieces whose contents are not valid yet are left empty so they can be downloaded into
+    """
     @staticmethod
-    def create_pieces(piece_hashes: bytes, raw_data: bytes, piece_length: int) -> list['Piece']:
+    def create_pieces(piece_hashes: bytes, raw_data: bytes, piece_length: int, total_length: int = None) -> list['Piece']:
         piece_count = len(piece_hashes) / PIECE_HASH_LENGTH
         pieces = []
         hash_offset = 0
@@ -27,8 +37,11 @@ class Piece:
             raw_piece_contents = raw_data[data_offset:data_offset + piece_length]
 
             piece = Piece(index, piece_hash)
-            if piece.try_set_contents(raw_piece_contents):
-                pieces.append(piece)
+            if not piece.try_set_contents(raw_piece_contents):
+                # The last piece is usually shorter than the others
+                length = piece_length if total_length is None else min(piece_length, total_length - data_offset)
+                piece.allocate(length)
+            pieces.append(piece)
 
             hash_offset += PIECE_HASH_LENGTH
             data_offset += piece_length
@@ -42,17 +55,52 @@ class Piece:
         return math.ceil(len(piece_hashes) / PIECE_HASH_LENGTH)
 
 
-    def add_block(self, block: Block, block_index: int):
-        if not self.blocks:
+    """
+    Empty blocks for a piece which still has to be downloaded
+    Every block is a view of one buffer for the whole piece, which becomes the piece data once it is verified
+    """
+    def allocate(self, length: int):
+        self.length = length
+        self.buffer = bytearray(length)
+        view = memoryview(self.buffer)
+        self.block_count = math.ceil(length / BLOCK_SIZE)
+        self.blocks = [
+            Block(i, block_size=min(BLOCK_SIZE, length - i * BLOCK_SIZE), data=view[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE])
+            for i in range(self.block_count)
+        ]
+        self.missing_blocks = self.block_count
+
+
+    """
+    Store a received block, once every block is there the piece is assembled and checked against its hash
+    Returns True when this block completed a valid piece
+    """
+    def add_block(self, block_index: int, data: bytes):
+        if self.data is not None or not 0 <= block_index < self.block_count:
             return False
-        
-        self.blocks[block_index] = block
 
-        if None not in self.blocks:
-            data = b''
-            for i in range(self.block_count):
-                block: Block = self.blocks[i]
-                data += block.data
+        block: Block = self.blocks[block_index]
+        if block.state == BlockState.FULL or len(data) != block.block_size:
+            return False
+
+        # The only copy on the download path, from the receive buffer into the piece
+        block.data[:] = data
+        block.state = BlockState.FULL
+        self.missing_blocks -= 1
+
+        if self.missing_blocks:
+            return False
+
+        if not self.valid(self.buffer):
+            # Corrupt piece, download it again
+            self.allocate(self.length)
+            return False
+
+        self.data = self.buffer
+        self.buffer = None
+        self.downloaded = True
+        self.verified = True
+        return True
 
 
     def try_set_contents(self, data: bytes):
@@ -61,13 +109,16 @@ class Piece:
 
         if self.valid(data):
             self.data = data
+            self.verified = True
             self.length = len(data)
             self.block_count = math.ceil(self.length / BLOCK_SIZE)
             self.blocks = [None] * self.block_count
 
+            # Blocks are views of the piece data rather than copies of it
+            view = memoryview(self.data)
             block_offset = 0
             for i in range(self.block_count):
-                block = Block(i, BlockState.FULL, data=self.data[block_offset:block_offset + BLOCK_SIZE])
+                block = Block(i, BlockState.FULL, data=view[block_offset:block_offset + BLOCK_SIZE])
                 self.blocks[i] = block
                 block_offset += BLOCK_SIZE
 
@@ -0,0 +1,153 @@
+from threading import Lock
+from block import BLOCK_SIZE
+from message import PEER_WIRE_MESSAGE_LENGTH
+import time
+
+# Seconds over which a measured rate is averaged
+RATE_AVERAGE_PERIOD = 5
+# Seconds of traffic a bandwidth limit lets through at once, kept short so limited transfers stay smooth
+BANDWIDTH_BURST_PERIOD = 0.1
+# Bandwidth buckets hold at least two Piece messages (a block and its 13 byte header), a message is only let through
+# once a bucket holds enough bytes for the whole of it
+MIN_BANDWIDTH_BURST = 2 * (PEER_WIRE_MESSAGE_LENGTH + 4*2 + BLOCK_SIZE)
+
+# Client wide bandwidth buckets are shared by the event loops of every torrent
+bandwidth_lock = Lock()
+
+# Measures a transfer rate, bytes are counted as they arrive and turned into a smoothed rate by update()
+class RateMeter():
+    __slots__ = ("rate", "total", "pending", "updated")
+
+    def __init__(self):
+        # Bytes per second
+        self.rate = 0.0
+        self.total = 0
+        # Counted since the last update
+        self.pending = 0
+        self.updated = time.monotonic()
+
+
+    def add(self, amount: int):
+        self.pending += amount
+        self.total += amount
+
+
+    """Fold the bytes counted since the last update into the rate, meant to be called periodically"""
+    def update(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+
+        elapsed = now - self.updated
+        if elapsed <= 0:
+            return
+
+        # Exponential moving average, weighted by how much of the averaging period has passed
+        weight = min(1, elapsed / RATE_AVERAGE_PERIOD)
+        self.rate += (self.pending / elapsed - self.rate) * weight
+        self.pending = 0
+        self.updated = now
+
+
+# Refills at rate tokens per second up to burst tokens, each unit of work takes tokens out
+class TokenBucket():
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+
+    def refill(self, now: float = None):
+        if now is None:
+            now = time.monotonic()
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def try_consume(self, amount: float = 1, now: float = None):
+        self.refill(now)
+
+        if self.tokens < amount:
+            return False
+
+        self.tokens -= amount
+        return True
+
+
+    """Take amount tokens even when there are fewer, the bucket stays in debt until it refilled"""
+    def consume(self, amount: float, now: float = None):
+        self.refill(now)
+        self.tokens -= amount
+
+
+    """Seconds until amount tokens are available"""
+    def delay(self, amount: float = 1, now: float = None):
+        self.refill(now)
+        return max(0, (amount - self.tokens) / self.rate)
+
+
+    def is_full(self, now: float = None):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+"""Token bucket limiting a transfer to rate bytes per second, None when rate is None, i.e. unlimited"""
+def create_bandwidth_bucket(rate: float) -> TokenBucket:
+    if rate is None:
+        return None
+
+    return TokenBucket(rate, max(MIN_BANDWIDTH_BURST, rate * BANDWIDTH_BURST_PERIOD))
+
+
+"""Seconds until every bucket holds amount bytes, amounts larger than a bucket's burst only wait for a full bucket"""
+def bandwidth_delay(buckets: list[TokenBucket], amount: int, now: float = None) -> float:
+    with bandwidth_lock:
+        return max((bucket.delay(min(amount, bucket.burst), now) for bucket in buckets), default=0)
+
+
+"""Account amount bytes in every bucket, returns seconds until none of them is in debt anymore"""
+def consume_bandwidth(buckets: list[TokenBucket], amount: int, now: float = None) -> float:
+    with bandwidth_lock:
+        for bucket in buckets:
+            bucket.consume(amount, now)
+
+        return max((bucket.delay(0, now) for bucket in buckets), default=0)
+
+
+# One token bucket per key (peer id, address...), created on first use
+class KeyedRateLimiter():
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: dict[object, TokenBucket] = {}
+        self.lock = Lock()
+
+
+    def try_acquire(self, key, amount: float = 1):
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+
+            return bucket.try_consume(amount, now)
+
+
+    """Forget keys whose bucket refilled completely, they behave exactly like new keys"""
+    def remove_idle(self):
+        now = time.monotonic()
+
+        with self.lock:
+            idle_keys = [key for key, bucket in self.buckets.items() if bucket.is_full(now)]
+            for key in idle_keys:
+                del self.buckets[key]
+
+        return len(idle_keys)
+
+
+    def __len__(self):
+        return len(self.buckets)
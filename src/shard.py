@@ -0,0 +1,92 @@
+import http.client
+import threading
+import zlib
+
+# Set on requests which were already forwarded by another shard, so they are never forwarded again
+FORWARDED_HEADER = "X-Tracker-Forwarded"
+# Seconds to wait for the owning shard to answer a forwarded request
+FORWARD_TIMEOUT = 5
+# Keep-alive connections to each other shard, shared by all worker threads
+# Forwards beyond this wait for a free connection instead of opening more
+FORWARD_CONNECTIONS = 8
+
+# Describes which part of the info hash space a tracker process owns, and where the other shards can be reached
+class Shard():
+    def __init__(self, index: int, count: int, addresses: list[tuple[str, int]], secret: bytes = None):
+        self.index = index
+        self.count = count
+        # Internal (address, port) of every shard, indexed by shard
+        self.addresses = addresses
+        # Shared by all shards so a UDP connection id from one shard is accepted by the others
+        self.secret = secret
+        self.create_connection_pools()
+
+
+    def create_connection_pools(self):
+        self.lock = threading.Lock()
+        # Open connections to each shard which are not in use, and the number of forwards allowed in flight
+        self.idle_connections: dict[int, list[http.client.HTTPConnection]] = {index: [] for index in range(self.count)}
+        self.connection_slots = {index: threading.BoundedSemaphore(FORWARD_CONNECTIONS) for index in range(self.count)}
+
+
+    """Same on every shard and across restarts, unlike hash()"""
+    def owner(self, info_hash: str) -> int:
+        return zlib.crc32(info_hash.encode("latin-1")) % self.count
+
+
+    def owns(self, info_hash: str):
+        return self.owner(info_hash) == self.index
+
+
+    """An idle pooled connection to the shard, or a new one, the caller must hold one of the shard's connection slots"""
+    def get_connection(self, shard_index: int) -> http.client.HTTPConnection:
+        with self.lock:
+            if self.idle_connections[shard_index]:
+                return self.idle_connections[shard_index].pop()
+
+        address, port = self.addresses[shard_index]
+        return http.client.HTTPConnection(address, port, timeout=FORWARD_TIMEOUT)
+
+
+    def release_connection(self, shard_index: int, connection: http.client.HTTPConnection):
+        with self.lock:
+            self.idle_connections[shard_index].append(connection)
+
+
+    """Send the request path to another shard, returns (status code, payload) or (None, None) if it is unreachable"""
+    def forward(self, shard_index: int, path: str):
+        slots = self.connection_slots[shard_index]
+        if not slots.acquire(timeout=FORWARD_TIMEOUT):
+            return None, None
+
+        try:
+            # The owning shard may have closed an idle keep-alive connection, retry once on a new one
+            for _ in range(2):
+                connection = self.get_connection(shard_index)
+                try:
+                    connection.request("GET", path, headers={FORWARDED_HEADER: str(self.index)})
+                    response = connection.getresponse()
+                    result = response.status, response.read()
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    continue
+
+                self.release_connection(shard_index, connection)
+                return result
+        finally:
+            slots.release()
+
+        return None, None
+
+
+    """Locks and open connections cannot be sent to a worker process"""
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("lock", "idle_connections", "connection_slots"):
+            del state[name]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.create_connection_pools()
@@ -0,0 +1,98 @@
+from tracker import Tracker
+from shard import Shard
+import multiprocessing
+import os
+import socket
+import sys
+
+DEBUG_MODE = True
+
+def run_shard(address: str, port: int, shard: Shard, stop_event, tracker_kwargs: dict):
+    tracker = Tracker(address, port, shard=shard, **tracker_kwargs)
+    tracker.start(new_thread=True)
+
+    try:
+        stop_event.wait()
+    except (SystemExit, KeyboardInterrupt):
+        pass
+    finally:
+        tracker.stop()
+
+
+# Runs one tracker process per shard, all listening on the same port with SO_REUSEPORT
+# Each info hash is owned by exactly one shard, requests which reach another shard are forwarded to the owner
+# over an internal port, so every swarm lives in a single registry
+class ShardedTracker():
+    # Shards reach each other over loopback, on consecutive ports starting at internal_port
+    INTERNAL_ADDRESS = "127.0.0.1"
+
+
+    def __init__(self, address: str, port: int, shard_count: int = None, internal_port: int = None, **tracker_kwargs):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise Exception("Sharded tracker requires SO_REUSEPORT, which is not supported on this platform")
+
+        # The shared port must be known in advance, an ephemeral port would differ between processes
+        if not port:
+            raise Exception("Sharded tracker requires a fixed port")
+
+        self.address = address
+        self.port = port
+        self.shard_count = shard_count or os.cpu_count() or 1
+        self.internal_port = internal_port or port + 1
+        self.tracker_kwargs = tracker_kwargs
+        self.processes: list[multiprocessing.Process] = []
+        self.stop_event = multiprocessing.Event()
+        self.running = False
+
+        addresses = [(ShardedTracker.INTERNAL_ADDRESS, self.internal_port + i) for i in range(self.shard_count)]
+        secret = os.urandom(16)
+        self.shards = [Shard(i, self.shard_count, addresses, secret) for i in range(self.shard_count)]
+
+
+    def start(self, new_thread: bool = False):
+        self.running = True
+        self.stop_event.clear()
+
+        for shard in self.shards:
+            tracker_kwargs = dict(self.tracker_kwargs)
+            # Each shard keeps its own snapshot
+            if snapshot_path := tracker_kwargs.get("snapshot_path"):
+                tracker_kwargs["snapshot_path"] = f"{snapshot_path}.{shard.index}"
+
+            process = multiprocessing.Process(
+                target = run_shard,
+                args = (self.address, self.port, shard, self.stop_event, tracker_kwargs),
+                name = f"tracker-shard-{shard.index}"
+            )
+            process.start()
+            self.processes.append(process)
+
+        if DEBUG_MODE:
+            print(f"Started {self.shard_count} tracker shards on {(self.address, self.port)}...")
+
+        if not new_thread:
+            try:
+                for process in self.processes:
+                    process.join()
+            except (SystemExit, KeyboardInterrupt):
+                self.stop()
+
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.running = False
+        self.stop_event.set()
+
+        for process in self.processes:
+            process.join(Tracker.PEER_INACTIVITY_TIMEOUT)
+            if process.is_alive():
+                print(f"Tracker shard {process.name} did not stop, terminating it", file=sys.stderr)
+                process.terminate()
+
+        self.processes = []
+
+
+    def __del__(self):
+        self.stop()
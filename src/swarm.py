@@ -0,0 +1,186 @@
+import bencode
+import random
+import socket
+import struct
+import time
+
+
+class PeerRecord():
+    # Trackers keep one record per announcing peer, avoid a __dict__ for each of them
+    __slots__ = ("peer_id", "address", "port", "seeding", "last_seen", "slot", "encoded")
+
+    def __init__(self, peer_id: str, address: str, port: int, seeding: bool, last_seen: float = None):
+        self.peer_id = peer_id
+        self.address = address
+        self.port = port
+        self.seeding = seeding
+        self.last_seen = last_seen if last_seen is not None else time.time()
+        # Position in the seeder or leecher list of the swarm
+        self.slot = None
+        # Bencoded peer dictionary, built on first use and reset when the seeding status changes
+        self.encoded = None
+
+
+    def endpoint(self):
+        return (self.address, self.port)
+
+
+    """4 byte IPv4 address followed by a 2 byte port (BEP 23), empty for peers without an IPv4 address"""
+    def to_compact(self):
+        try:
+            return socket.inet_pton(socket.AF_INET, self.address) + struct.pack("!H", self.port)
+        except (OSError, TypeError):
+            return b''
+
+
+    def to_bencode(self):
+        if self.encoded is None:
+            self.encoded = bencode.encode({
+                "peer id": self.peer_id,
+                "ip": self.address,
+                "port": self.port,
+                "seeding": self.seeding
+            })
+        return self.encoded
+
+
+# All peers which announced themselves to the tracker for a single info hash
+class Swarm():
+    def __init__(self, info_hash: str):
+        self.info_hash = info_hash
+        self.peers: dict[str, PeerRecord] = {}
+        # (address, port) -> peer id, so duplicate endpoints are found without scanning every peer
+        self.endpoints: dict[tuple[str, int], str] = {}
+        # Seeders and leechers are also kept in lists so a random sample does not depend on the swarm size
+        self.seeder_list: list[PeerRecord] = []
+        self.leecher_list: list[PeerRecord] = []
+        # Number of peers which finished downloading the torrent
+        self.completed = 0
+        # Incremented whenever the peer list changes, invalidates the cached encodings
+        self.version = 0
+        # compact flag -> (version, encoded peers, peer id -> (start, end) offsets in the encoded peers)
+        self.encoding_cache = {}
+
+
+    def get_peer(self, peer_id: str) -> PeerRecord:
+        return self.peers.get(peer_id)
+
+
+    def find_peer(self, address: str, port: int) -> PeerRecord:
+        peer_id = self.endpoints.get((address, port))
+        if peer_id is None:
+            return None
+        return self.peers[peer_id]
+
+
+    @property
+    def seeders(self):
+        return len(self.seeder_list)
+
+
+    @property
+    def leechers(self):
+        return len(self.leecher_list)
+
+
+    def add_peer(self, peer: PeerRecord):
+        self.peers[peer.peer_id] = peer
+        self.endpoints[peer.endpoint()] = peer.peer_id
+        self.insert_slot(peer)
+        self.version += 1
+
+
+    def remove_peer(self, peer_id: str) -> PeerRecord:
+        peer = self.peers.pop(peer_id, None)
+        if peer is None:
+            return None
+
+        del self.endpoints[peer.endpoint()]
+        self.remove_slot(peer)
+        self.version += 1
+
+        return peer
+
+
+    def set_seeding(self, peer: PeerRecord, seeding: bool):
+        if peer.seeding == seeding:
+            return
+
+        self.remove_slot(peer)
+        peer.seeding = seeding
+        peer.encoded = None
+        self.insert_slot(peer)
+        self.version += 1
+
+
+    def insert_slot(self, peer: PeerRecord):
+        peer_list = self.seeder_list if peer.seeding else self.leecher_list
+        peer.slot = len(peer_list)
+        peer_list.append(peer)
+
+
+    """Swap the peer with the last one in its list so removal is O(1)"""
+    def remove_slot(self, peer: PeerRecord):
+        peer_list = self.seeder_list if peer.seeding else self.leecher_list
+        last_peer = peer_list.pop()
+
+        if last_peer is not peer:
+            peer_list[peer.slot] = last_peer
+            last_peer.slot = peer.slot
+
+        peer.slot = None
+
+
+    """
+    Pick up to count random peers, excluding the requesting peer
+    Leechers are given seeders first and seeders are given leechers first
+    """
+    def sample_peers(self, count: int, requesting_peer_id: str = None, prefer_seeders: bool = True) -> list[PeerRecord]:
+        if prefer_seeders:
+            peer_lists = (self.seeder_list, self.leecher_list)
+        else:
+            peer_lists = (self.leecher_list, self.seeder_list)
+
+        peers = []
+        for peer_list in peer_lists:
+            remaining = count - len(peers)
+            if remaining <= 0:
+                break
+
+            # Take one extra in case the requesting peer is drawn
+            for peer in random.sample(peer_list, min(remaining + 1, len(peer_list))):
+                if peer.peer_id != requesting_peer_id and len(peers) < count:
+                    peers.append(peer)
+
+        return peers
+
+
+    """Encoding of every peer in the swarm, rebuilt only when the swarm changed since the last call"""
+    def encode_peers(self, compact: bool) -> tuple[bytes, dict]:
+        cached = self.encoding_cache.get(compact)
+        if cached and cached[0] == self.version:
+            return cached[1], cached[2]
+
+        chunks = []
+        offsets = {}
+        offset = 0
+
+        for peer_list in (self.seeder_list, self.leecher_list):
+            for peer in peer_list:
+                chunk = peer.to_compact() if compact else peer.to_bencode()
+                chunks.append(chunk)
+                offsets[peer.peer_id] = (offset, offset + len(chunk))
+                offset += len(chunk)
+
+        encoded = b''.join(chunks)
+        self.encoding_cache[compact] = (self.version, encoded, offsets)
+
+        return encoded, offsets
+
+
+    def __len__(self):
+        return len(self.peers)
+
+
+    def __contains__(self, peer_id: str):
+        return peer_id in self.peers
@@ -127,10 +127,10 @@ class Torrent():
                     offset += self.piece_length
 
             raw_data = file.read(self.piece_length * self.piece_count)
-            self.pieces = Piece.create_pieces(self.piece_hashes, raw_data, self.piece_length)
+            self.pieces = Piece.create_pieces(self.piece_hashes, raw_data, self.piece_length, self.total_length)
 
         for piece in self.pieces:
-            if piece.valid():
+            if piece.verified:
                 self.bitfield.set(value=1, pos=piece.index)
         
         print("Bitfield: ", self.bitfield)
@@ -139,7 +139,7 @@ class Torrent():
     # Client downloads a new piece
     def write_pieces(self, save_path: str):
         for piece in self.pieces:
-            if piece.valid():
+            if piece.verified:
                 self.write_piece(piece, save_path)
                 self.bitfield.set(value=1, pos=piece.index)
 
@@ -156,5 +156,9 @@ class Torrent():
         file.close()
 
 
+    def is_complete(self):
+        return all(piece.verified for piece in self.pieces)
+
+
     def __str__(self):
         return ''.join('1' if bit else '0' for bit in self.bitfield)
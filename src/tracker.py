@@ -1,36 +1,170 @@
-from threading import Thread
+from threading import Thread, RLock, Event, current_thread
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
 from prettytable import PrettyTable
+from swarm import Swarm, PeerRecord
+from shard import Shard, FORWARDED_HEADER
+from tracker_stats import TrackerStats
+from rate_limit import KeyedRateLimiter
+import util
 import bencode
+import collections
+import hashlib
+import heapq
+import hmac
+import json
+import os
+import itertools
 import time
 import urllib.parse
 import requests
+import selectors
+import socket
+import struct
 import sys
 
 DEBUG_MODE = True
+# Print every request and the whole peer table on each announce, this is slow with many peers so it is off by default
+# and /stats should be used to watch the tracker instead
+LOG_REQUESTS = False
+
+# 4 byte IPv4 address followed by a 2 byte port in network byte order
+COMPACT_PEER_LENGTH = 6
+
+# UDP tracker protocol (BEP 15)
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECT_ACTION = 0
+UDP_ANNOUNCE_ACTION = 1
+UDP_SCRAPE_ACTION = 2
+UDP_ERROR_ACTION = 3
+UDP_CONNECT_REQUEST_LENGTH = 16
+UDP_ANNOUNCE_REQUEST_LENGTH = 98
+UDP_ANNOUNCE_RESPONSE_LENGTH = 20
+# Seeders, completed and leechers for each scraped info hash
+UDP_SCRAPE_ENTRY_LENGTH = 12
+UDP_MAX_SCRAPE_HASHES = 74
+UDP_MAX_DATAGRAM_SIZE = 2048
+# Announce event field
+UDP_EVENTS = {0: "none", 1: "completed", 2: "started", 3: "stopped"}
+UDP_EVENT_IDS = {event: event_id for event_id, event in UDP_EVENTS.items()}
+# Connection ids may be used by clients for a minute, and are accepted by the tracker for up to two
+UDP_CONNECTION_ID_LIFETIME = 60
+
+# Scrape responses are keyed by raw info hashes, which the default decoder rejects as dictionary keys
+SCRAPE_DECODER = bencode.Bencode(encoding="utf-8", encoding_fallback="all", dict_ordered=True)
 
 class TrackerRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open between announces so clients can reuse them, only when requests are served by workers
+    protocol_version = "HTTP/1.1"
+    # Seconds to wait for the rest of a request once its connection became readable
+    timeout = 5
+    # Headers and body are written separately, avoid waiting on delayed ACKs between them
+    disable_nagle_algorithm = True
+
     def __init__(self, tracker: 'Tracker', *args, **kwargs):
         self.tracker = tracker
         super().__init__(*args, **kwargs)
 
 
+    def setup(self):
+        super().setup()
+        # Served inline the connection would block every other client until it is closed
+        if not self.server.executor:
+            self.protocol_version = "HTTP/1.0"
+
+
+    """
+    Answer the request which made the connection readable, and any further one the client already sent
+    Waiting for the next request is left to the server's idle selector, so an idle connection holds no worker
+    """
+    def handle(self):
+        self.handle_one_request()
+        while not self.close_connection and self.has_pending_request():
+            self.handle_one_request()
+
+
+    def has_pending_request(self):
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(0)
+
+        try:
+            # Buffered bytes, or whatever the socket has right now, without blocking
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+
     """This is tracker._server.handle_request()"""
     def do_GET(self):
+        start = time.perf_counter()
         parsed_url = urllib.parse.urlparse(self.path)
-        query_params = urllib.parse.parse_qs(parsed_url.query)
-        print(query_params)
+        # info_hash is raw binary, latin-1 maps every byte to one character so it matches UDP announces
+        query_params = urllib.parse.parse_qs(parsed_url.query, encoding="latin-1")
+        if LOG_REQUESTS:
+            print(query_params)
+
+        # Requests forwarded by another shard are always answered from the local registry
+        # The header is only trusted on the internal listener, public clients could set it to skip rate limiting
+        forwarded = self.server.trust_forwarded and self.headers.get(FORWARDED_HEADER) is not None
+        path = parsed_url.path.rstrip("/")
+
+        if path.endswith("/stats"):
+            self.send_stats_response()
+            return
+
+        if path.endswith("/scrape"):
+            self.send_scrape_response(query_params.get("info_hash", []), forwarded)
+            self.tracker.stats.record_scrape()
+            return
+
+        self.handle_announce(query_params, forwarded)
+        self.tracker.stats.record_announce(time.perf_counter() - start, self.response_size, self.response_status != 200)
+
 
+    def handle_announce(self, query_params: dict, forwarded: bool = False):
         if not query_params:
             self.send_error_response("Payload required")
             return
 
-        peer_address = query_params.get("peer_address")[0]
+        peer_address = query_params.get("peer_address", [self.client_address[0]])[0]
         peer_id = query_params.get("peer_id")[0]
         peer_port = query_params.get("port")[0]
         info_hash = query_params.get("info_hash")[0]
         event = query_params.get("event")[0]
         seeding = query_params.get("seeding")[0].lower() == "true"
+        compact = query_params.get("compact", ["0"])[0] == "1"
+
+        # Stored addresses end up in compact peer lists, which only hold IPv4 addresses
+        if not util.is_ipv4_address(peer_address):
+            self.send_error_response("Bad address")
+            return
+
+        # Forwarded requests were already rate limited by the shard which received them
+        if not forwarded and not self.tracker.allow_client(peer_id, self.client_address[0]):
+            self.send_refusal()
+            return
+
+        # Another shard owns this torrent, relay its answer instead of touching the local registry
+        if not forwarded and not self.tracker.owns(info_hash):
+            path = self.path
+            # The owning shard would only see this shard's address, pass on the client's
+            if "peer_address" not in query_params:
+                path += ("&" if "?" in path else "?") + urllib.parse.urlencode({"peer_address": peer_address})
+
+            status_code, payload = self.tracker.forward_request(info_hash, path)
+            if status_code is None:
+                self.send_error_response("Tracker shard unavailable")
+            else:
+                self.send_payload(status_code, payload)
+            return
+
+        try:
+            numwant = int(query_params.get("numwant", [Tracker.DEFAULT_NUMWANT])[0])
+        except ValueError:
+            numwant = Tracker.DEFAULT_NUMWANT
+        numwant = util.clamp(numwant, 0, Tracker.MAX_NUMWANT)
 
         try:
             peer_port = int(peer_port)
@@ -38,45 +172,458 @@ class TrackerRequestHandler(BaseHTTPRequestHandler):
             self.send_error_response("Bad port")
             return
 
+        if self.tracker.announced_recently(info_hash, peer_id, event):
+            self.send_refusal()
+            return
+
         if event == "started":
             self.tracker.try_add_peer(info_hash, peer_id, peer_address, peer_port, seeding)
         elif event == "stopped":
             # Peer has requested to remove itself from the peer list
             self.tracker.remove_peer(info_hash, peer_id)
         elif event == "completed":
-            # TODO: Handle actions when peer is finished downloading
-            pass
+            # Peer finished downloading and is now seeding
+            self.tracker.complete_peer(info_hash, peer_id, peer_address, peer_port)
+            seeding = True
         else:
             self.send_error_response("Bad event")
             return
         
         # Display peer table stored by tracker
-        if DEBUG_MODE:
+        if LOG_REQUESTS:
             print(self.tracker)
 
-        self.send_success_response(info_hash, peer_id)
+        self.send_success_response(info_hash, peer_id, compact, numwant, seeding)
     
 
-    def send_success_response(self, info_hash: str, requesting_peer_id: str):
-        response_payload = {
-            "interval": self.tracker.interval,
-            "tracker id": self.tracker.tracker_id,
-            "complete": 0,
-            "incomplete": 0,
-            "peers": self.tracker.build_verbose_peer_list(info_hash, requesting_peer_id)
-        }
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(bencode.encode(response_payload))
+    def send_success_response(self, info_hash: str, requesting_peer_id: str, compact: bool = False, numwant: int = None, seeding: bool = False):
+        if numwant is None:
+            numwant = Tracker.DEFAULT_NUMWANT
+
+        peers = self.tracker.encode_peer_list(info_hash, requesting_peer_id, compact, numwant, seeding)
+        complete, incomplete, _ = self.tracker.get_swarm_stats(info_hash)
+
+        # Same bytes as bencode.encode() of the response dictionary, keys are written in sorted order
+        # and the already encoded peer list is spliced in
+        response_payload = b''.join((
+            b"d8:completei%de" % complete,
+            b"10:incompletei%de" % incomplete,
+            b"8:intervali%de" % self.tracker.interval,
+            b"12:min intervali%de" % self.tracker.min_interval,
+            b"5:peers", peers,
+            b"10:tracker idi%de" % self.tracker.tracker_id,
+            b"e"
+        ))
+        self.send_payload(200, response_payload)
+
+
+    """Swarm statistics for each requested info hash, or for every torrent when none are given (BEP 48)"""
+    def send_scrape_response(self, info_hashes: list[str], forwarded: bool = False):
+        files = {}
+        stats = self.tracker.scrape(info_hashes) if forwarded else self.tracker.scrape_all_shards(info_hashes)
+
+        for info_hash, (complete, incomplete, downloaded) in stats.items():
+            # Keys are the raw 20 byte info hashes
+            files[info_hash.encode("latin-1")] = {
+                "complete": complete,
+                "downloaded": downloaded,
+                "incomplete": incomplete
+            }
+
+        self.send_payload(200, bencode.encode({"files": files}))
+
+
+    """Pre-encoded answer to clients announcing too often, nothing is looked up or added to the registry"""
+    def send_refusal(self):
+        self.send_payload(403, self.tracker.refusal_payload)
+        self.tracker.stats.record_refused()
+
+
+    """Counters and histograms of the tracker as JSON, meant for people and monitoring rather than peers"""
+    def send_stats_response(self):
+        payload = json.dumps(self.tracker.stats.to_dict(self.tracker), indent=2).encode()
+        self.send_payload(200, payload, "application/json")
 
 
     def send_error_response(self, failure_reason: str):
         response_payload = {
             "failure reason": failure_reason
         }
-        self.send_response(403)
+        self.send_payload(403, bencode.encode(response_payload))
+
+
+    def send_payload(self, status_code: int, payload: bytes, content_type: str = "text/plain"):
+        self.response_status = status_code
+        self.response_size = len(payload)
+
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        # Required to keep the connection alive with HTTP/1.1
+        self.send_header("Content-Length", str(len(payload)))
         self.end_headers()
-        self.wfile.write(bencode.encode(response_payload))
+        self.wfile.write(payload)
+
+
+    """Access log on stderr, written for every request so it is only enabled together with LOG_REQUESTS"""
+    def log_message(self, format: str, *args):
+        if LOG_REQUESTS:
+            super().log_message(format, *args)
+
+
+# Workers only get a connection when it has a request to read. New and idle keep-alive connections wait on a
+# selector watched by one thread, so clients which keep their connection open, or connect and send nothing, cost no worker
+class TrackerServer(HTTPServer):
+    # Seconds a connection may wait for its next request before it is closed
+    IDLE_TIMEOUT = 15
+
+    def __init__(self, tracker: 'Tracker', server_address: tuple, max_workers: int = 0, reuse_port: bool = False, trust_forwarded: bool = False):
+        self.tracker = tracker
+        # Only the internal listener of a shard receives requests forwarded by the other shards
+        self.trust_forwarded = trust_forwarded
+        # Lets several tracker processes listen on the same port, the kernel spreads connections between them
+        self.reuse_port = reuse_port
+        # Requests are handled on the serving thread when no workers are requested
+        self.executor = ThreadPoolExecutor(max_workers, "tracker-worker") if max_workers > 0 else None
+
+        super().__init__(
+            server_address,
+            # Pass a reference to the tracker to the request handler
+            lambda *args, **kwargs: TrackerRequestHandler(tracker, *args, **kwargs)
+        )
+
+        self.closed = False
+        self.idle_thread = None
+        if self.executor:
+            # Connections handed back by workers, registered by the idle thread which owns the selector
+            self.parked_connections = collections.deque()
+            self.idle_selector = selectors.DefaultSelector()
+            self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+            self.wakeup_receiver.setblocking(False)
+            self.wakeup_sender.setblocking(False)
+            self.idle_selector.register(self.wakeup_receiver, selectors.EVENT_READ, None)
+
+            self.idle_thread = Thread(target = self.watch_idle_connections, name="tracker-idle")
+            self.idle_thread.daemon = True
+            self.idle_thread.start()
+
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+    """Wait for the accepted connection's first request on the idle selector instead of serving it inline"""
+    def process_request(self, request, client_address):
+        if not self.executor:
+            super().process_request(request, client_address)
+            return
+
+        self.park_connection(request, client_address)
+
+
+    """Returns True when the connection stays open for another request"""
+    def finish_request(self, request, client_address):
+        handler = self.RequestHandlerClass(request, client_address, self)
+        return not handler.close_connection
+
+
+    def process_request_thread(self, request, client_address):
+        keep_alive = False
+
+        try:
+            keep_alive = self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if keep_alive and not self.closed:
+                self.park_connection(request, client_address)
+            else:
+                self.shutdown_request(request)
+
+
+    """Safe to call from any thread"""
+    def park_connection(self, request, client_address):
+        self.parked_connections.append((request, client_address))
+        self.wake_idle_thread()
+
+
+    def wake_idle_thread(self):
+        try:
+            self.wakeup_sender.send(b'\x00')
+        except (BlockingIOError, InterruptedError):
+            # Wakeup socket is full, the idle thread is already going to wake up
+            pass
+
+
+    """Hand readable connections to the workers and close the ones which stayed idle for too long"""
+    def watch_idle_connections(self):
+        last_expiry = time.monotonic()
+
+        while not self.closed:
+            for key, _ in self.idle_selector.select(Tracker.POLL_INTERVAL):
+                if key.data is None:
+                    self.drain_wakeup()
+                    continue
+
+                self.idle_selector.unregister(key.fileobj)
+                try:
+                    self.executor.submit(self.process_request_thread, key.fileobj, key.data[0])
+                except RuntimeError:
+                    # Executor was shut down
+                    self.shutdown_request(key.fileobj)
+
+            now = time.monotonic()
+            while self.parked_connections:
+                request, client_address = self.parked_connections.popleft()
+                self.idle_selector.register(request, selectors.EVENT_READ, (client_address, now))
+
+            if now - last_expiry >= Tracker.POLL_INTERVAL:
+                last_expiry = now
+                self.close_idle_connections(now)
+
+        for key in list(self.idle_selector.get_map().values()):
+            if key.data is not None:
+                self.shutdown_request(key.fileobj)
+        while self.parked_connections:
+            self.shutdown_request(self.parked_connections.popleft()[0])
+        self.idle_selector.close()
+
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+
+    def close_idle_connections(self, now: float):
+        expired = [
+            key.fileobj for key in self.idle_selector.get_map().values()
+            if key.data is not None and now - key.data[1] > TrackerServer.IDLE_TIMEOUT
+        ]
+
+        for request in expired:
+            self.idle_selector.unregister(request)
+            self.shutdown_request(request)
+
+
+    def server_close(self):
+        super().server_close()
+        if self.executor and not self.closed:
+            self.closed = True
+            self.wake_idle_thread()
+            self.idle_thread.join()
+            self.wakeup_receiver.close()
+            self.wakeup_sender.close()
+            self.executor.shutdown(wait=False)
+
+
+class UdpTrackerServer():
+    def __init__(self, tracker: 'Tracker', server_address: tuple, reuse_port: bool = False, secret: bytes = None):
+        self.tracker = tracker
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(server_address)
+        # Wake up periodically to check whether the tracker was stopped
+        self.socket.settimeout(Tracker.POLL_INTERVAL)
+        self.server_address = self.socket.getsockname()
+        # Connection ids are derived from the client IP, so no per-client state is kept
+        self.secret = secret if secret else os.urandom(16)
+
+
+    def serve(self):
+        while self.tracker.running:
+            try:
+                request, client_address = self.socket.recvfrom(UDP_MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                # Socket closed while stopping
+                break
+
+            try:
+                response = self.handle_datagram(request, client_address)
+            except Exception as e:
+                # One bad request must not take down the listener
+                print(f"Failed to handle UDP tracker request from {client_address}: {e}", file=sys.stderr)
+                response = None
+                if len(request) >= UDP_CONNECT_REQUEST_LENGTH:
+                    transaction_id = struct.unpack_from("!I", request, 12)[0]
+                    response = self.error_response(transaction_id, "Internal error")
+
+            if response:
+                try:
+                    self.socket.sendto(response, client_address)
+                except OSError as e:
+                    if DEBUG_MODE:
+                        print(f"Failed to send UDP tracker response to {client_address}: {e}", file=sys.stderr)
+
+
+    def handle_datagram(self, request: bytes, client_address: tuple):
+        if len(request) < UDP_CONNECT_REQUEST_LENGTH:
+            return None
+
+        connection_id, action, transaction_id = struct.unpack("!QII", request[:UDP_CONNECT_REQUEST_LENGTH])
+
+        if action == UDP_CONNECT_ACTION:
+            if connection_id != UDP_PROTOCOL_ID:
+                return None
+            return struct.pack("!IIQ", UDP_CONNECT_ACTION, transaction_id, self.create_connection_id(client_address))
+
+        if not self.valid_connection_id(connection_id, client_address):
+            return self.error_response(transaction_id, "Bad connection id")
+
+        if action == UDP_ANNOUNCE_ACTION:
+            start = time.perf_counter()
+            response = self.handle_announce(request, transaction_id, client_address)
+            failed = struct.unpack("!I", response[:4])[0] == UDP_ERROR_ACTION
+            self.tracker.stats.record_announce(time.perf_counter() - start, len(response), failed, udp=True)
+            return response
+
+        if action == UDP_SCRAPE_ACTION:
+            self.tracker.stats.record_scrape()
+            return self.handle_scrape(request, transaction_id)
+
+        return self.error_response(transaction_id, "Bad action")
+
+
+    def handle_announce(self, request: bytes, transaction_id: int, client_address: tuple):
+        if len(request) < UDP_ANNOUNCE_REQUEST_LENGTH:
+            return self.error_response(transaction_id, "Bad announce")
+
+        (_, _, _, raw_info_hash, raw_peer_id, _, left, _, event_id, raw_ip, _, numwant, peer_port) = struct.unpack(
+            "!QII20s20sQQQIIIiH", request[:UDP_ANNOUNCE_REQUEST_LENGTH])
+
+        # Same keys as the HTTP handler, which decodes the query string as latin-1
+        info_hash = raw_info_hash.decode("latin-1")
+        peer_id = raw_peer_id.decode("latin-1")
+        # An IP of 0 means the tracker should use the address the datagram came from
+        peer_address = socket.inet_ntoa(struct.pack("!I", raw_ip)) if raw_ip else client_address[0]
+        seeding = left == 0
+        event = UDP_EVENTS.get(event_id)
+
+        if numwant < 0:
+            numwant = Tracker.DEFAULT_NUMWANT
+        numwant = util.clamp(numwant, 0, Tracker.MAX_NUMWANT)
+
+        if not self.tracker.allow_client(peer_id, client_address[0]):
+            return self.refusal_response(transaction_id)
+
+        if event is not None and not self.tracker.owns(info_hash):
+            return self.forward_announce(transaction_id, info_hash, peer_id, peer_address, peer_port, event, seeding, numwant)
+
+        if self.tracker.announced_recently(info_hash, peer_id, event):
+            return self.refusal_response(transaction_id)
+
+        if event in ("none", "started"):
+            self.tracker.try_add_peer(info_hash, peer_id, peer_address, peer_port, seeding)
+        elif event == "stopped":
+            self.tracker.remove_peer(info_hash, peer_id)
+        elif event == "completed":
+            self.tracker.complete_peer(info_hash, peer_id, peer_address, peer_port)
+            seeding = True
+        else:
+            return self.error_response(transaction_id, "Bad event")
+
+        peers = self.tracker.get_encoded_peers(info_hash, peer_id, True, numwant, seeding)
+        seeders, leechers, _ = self.tracker.get_swarm_stats(info_hash)
+
+        response = struct.pack("!IIIII", UDP_ANNOUNCE_ACTION, transaction_id, self.tracker.interval, leechers, seeders)
+        return response + peers
+
+
+    """Announce to the owning shard over HTTP and translate its answer into a UDP announce response"""
+    def forward_announce(self, transaction_id: int, info_hash: str, peer_id: str, peer_address: str, peer_port: int, event: str, seeding: bool, numwant: int):
+        query = urllib.parse.urlencode({
+            "info_hash": info_hash,
+            "peer_id": peer_id,
+            "peer_address": peer_address,
+            "port": peer_port,
+            # Regular UDP announces are handled like started events
+            "event": "started" if event == "none" else event,
+            "compact": 1,
+            "seeding": seeding,
+            "numwant": numwant
+        }, encoding="latin-1")
+
+        status_code, payload = self.tracker.forward_request(info_hash, "/?" + query)
+        if status_code is None:
+            return self.error_response(transaction_id, "Tracker shard unavailable")
+
+        try:
+            response = bencode.decode(payload)
+        except bencode.BencodeDecodeError:
+            return self.error_response(transaction_id, "Tracker shard unavailable")
+
+        if status_code != 200:
+            return self.error_response(transaction_id, response.get("failure reason", "Announce failed"))
+
+        peers = response.get("peers", b'')
+        # The bencode decoder returns strings which happen to be valid UTF-8 as str
+        if isinstance(peers, str):
+            peers = peers.encode("utf-8")
+
+        header = struct.pack("!IIIII", UDP_ANNOUNCE_ACTION, transaction_id, response["interval"], response["incomplete"], response["complete"])
+        return header + peers
+
+
+    def handle_scrape(self, request: bytes, transaction_id: int):
+        raw_info_hashes = request[UDP_CONNECT_REQUEST_LENGTH:]
+        info_hashes = [
+            raw_info_hashes[offset:offset + 20].decode("latin-1")
+            for offset in range(0, len(raw_info_hashes) - 19, 20)
+        ][:UDP_MAX_SCRAPE_HASHES]
+
+        if not info_hashes:
+            return self.error_response(transaction_id, "Bad scrape")
+
+        stats = self.tracker.scrape_all_shards(info_hashes)
+        response = [struct.pack("!II", UDP_SCRAPE_ACTION, transaction_id)]
+
+        # Entries are in the same order as the requested hashes
+        for info_hash in info_hashes:
+            # Missing when the shard owning the hash could not be reached
+            seeders, leechers, completed = stats.get(info_hash, (0, 0, 0))
+            response.append(struct.pack("!III", seeders, completed, leechers))
+
+        return b''.join(response)
+
+
+    def refusal_response(self, transaction_id: int):
+        self.tracker.stats.record_refused()
+        return self.error_response(transaction_id, Tracker.REFUSAL_REASON)
+
+
+    def error_response(self, transaction_id: int, failure_reason: str):
+        return struct.pack("!II", UDP_ERROR_ACTION, transaction_id) + failure_reason.encode("utf-8")
+
+
+    def create_connection_id(self, client_address: tuple, window: int = None):
+        if window is None:
+            window = int(time.time() // UDP_CONNECTION_ID_LIFETIME)
+
+        # Only the IP is used, clients send each announce from a new socket
+        message = f"{client_address[0]}:{window}".encode()
+        digest = hmac.new(self.secret, message, hashlib.sha1).digest()
+        return struct.unpack("!Q", digest[:8])[0]
+
+
+    def valid_connection_id(self, connection_id: int, client_address: tuple):
+        window = int(time.time() // UDP_CONNECTION_ID_LIFETIME)
+
+        # Accept ids handed out in the current or the previous window
+        for w in (window, window - 1):
+            if hmac.compare_digest(struct.pack("!Q", connection_id), struct.pack("!Q", self.create_connection_id(client_address, w))):
+                return True
+
+        return False
+
+
+    def server_close(self):
+        self.socket.close()
 
 
 class Tracker():
@@ -84,27 +631,104 @@ class Tracker():
     PEER_INACTIVITY_TIMEOUT = 30
     # Time between tracker requests used if not specified by tracker
     DEFAULT_TRACKER_INTERVAL = 9
+    # Regular announces from a peer sooner than this many seconds after its last one are refused
+    DEFAULT_MIN_INTERVAL = 5
+    # Announces per second and burst allowed for each peer id, and for each client address
+    # Addresses get more room since several peers can share one behind NAT
+    PEER_ANNOUNCE_RATE = 1
+    PEER_ANNOUNCE_BURST = 10
+    ADDRESS_ANNOUNCE_RATE = 20
+    ADDRESS_ANNOUNCE_BURST = 100
+    # Seconds between removals of rate limits for clients which have been quiet long enough to be back at full burst
+    RATE_LIMIT_CLEANUP_INTERVAL = 30
+    REFUSAL_REASON = "Announcing too often"
     MAX_PEERS = 50
+    # Number of peers returned per announce when the peer does not send numwant
+    DEFAULT_NUMWANT = 50
+    # Upper bound on numwant, regardless of what the peer asks for
+    MAX_NUMWANT = 200
+    # Number of threads serving announces concurrently
+    DEFAULT_WORKER_COUNT = 64
+    # Seconds between checks for a shutdown request while serving
+    POLL_INTERVAL = 0.5
+    # Seconds between removals of expired peers, independent of the request rate
+    EXPIRY_INTERVAL = 1
+    # Seconds between snapshots of the peer registry, when a snapshot path is given
+    SNAPSHOT_INTERVAL = 10
+    SNAPSHOT_FORMAT_VERSION = 1
+    # Seconds to wait for a UDP tracker to answer before retrying
+    UDP_TIMEOUT = 5
+    UDP_RETRIES = 2
+    # Cached UDP connection ids, (host, port) -> (connection id, time received)
+    udp_connections = {}
 
 
-    def __init__(self, address: str, port: int, interval: int = 9):
+    def __init__(self, address: str, port: int, interval: int = 9, concurrent: bool = True, max_workers: int = DEFAULT_WORKER_COUNT, max_peers: int = MAX_PEERS, udp_port: int = None, snapshot_path: str = None, shard: Shard = None, min_interval: int = DEFAULT_MIN_INTERVAL, rate_limit: bool = True):
         self.port = port
         self.running = False
         self.interval = interval
-        self.torrents = {str: {}}
+        self.min_interval = min(min_interval, interval)
+        # Per peer id and per client address announce limits, skipped entirely when rate_limit is off
+        self.rate_limit = rate_limit
+        self.peer_limiter = KeyedRateLimiter(Tracker.PEER_ANNOUNCE_RATE, Tracker.PEER_ANNOUNCE_BURST)
+        self.address_limiter = KeyedRateLimiter(Tracker.ADDRESS_ANNOUNCE_RATE, Tracker.ADDRESS_ANNOUNCE_BURST)
+        self.last_rate_limit_cleanup = time.time()
+        # Same answer for every refused announce, so it is only encoded once
+        self.refusal_payload = bencode.encode({
+            "failure reason": Tracker.REFUSAL_REASON,
+            "interval": interval,
+            "min interval": self.min_interval
+        })
+        self.max_peers = max_peers
+        self.torrents: dict[str, Swarm] = {}
+        # Running totals across all torrents, kept up to date as peers are added and removed
+        self.peer_count = 0
+        self.seeder_count = 0
+        # Min-heap of (expiry deadline, sequence number, info hash, peer record), so only expiring peers are visited
+        self.expiry_queue = []
+        self.expiry_sequence = itertools.count()
+        self.maintenance_thread = None
+        self.stop_event = Event()
         self.tracker_id = 0 # TODO: Unique tracker ids are not needed currently
         self.thread = None
+        # Thread running serve_forever, the caller's own thread when started without new_thread
+        self.serving_thread: Thread = None
         self.count = 0
+        # Guards the peer lists, which are shared by all worker threads
+        self.lock = RLock()
+        # Set when this tracker is one of several processes sharing the same port, see sharded_tracker.py
+        self.shard = shard
+        # Served on /stats
+        self.stats = TrackerStats()
 
-        self._server = HTTPServer(
+        # Registry is saved here periodically and restored on startup, so a restart does not empty every swarm
+        self.snapshot_path = snapshot_path
+        self.last_snapshot = time.time()
+        if snapshot_path:
+            self.load_snapshot(snapshot_path)
+
+        self._server = TrackerServer(
+            self,
             # Empty string automatically defaults to loopback address
             (address, self.port),
-            # Pass a reference to the tracker to the http server
-            lambda *args, **kwargs: TrackerRequestHandler(self, *args, **kwargs)
+            max_workers if concurrent else 0,
+            reuse_port=shard is not None
         )
-        # Block for 5 seconds before checking for keyboard interrupts if running on main thread
-        self._server.timeout = 5
         self.address = self._server.server_address
+
+        # Other shards forward requests for the torrents this shard owns to its own address
+        self.internal_server = None
+        self.internal_thread = None
+        if shard:
+            self.internal_server = TrackerServer(self, shard.addresses[shard.index], max_workers if concurrent else 0, trust_forwarded=True)
+
+        # UDP announces are only served when a port is given
+        if udp_port is not None:
+            self.udp_server = UdpTrackerServer(self, (address, udp_port), reuse_port=shard is not None, secret=shard.secret if shard else None)
+        else:
+            self.udp_server = None
+        self.udp_address = self.udp_server.server_address if self.udp_server else None
+        self.udp_thread = None
     
 
     """ Retrieve list of peers from a tracker """
@@ -116,7 +740,10 @@ class Tracker():
                              info_hash: str,
                              seeding: bool = False,
                              event: str = "started",
-                             compact: int = 0):
+                             compact: int = 0,
+                             numwant: int = None,
+                             session: requests.Session = None,
+                             timeout = None):
 
         # Create request payload
         request_payload = {
@@ -129,18 +756,21 @@ class Tracker():
             "left": 1000,
             "event": event,
             "compact": compact,
-            "seeding": seeding
+            "seeding": seeding,
+            # Omitted from the query when None, the tracker then uses its default
+            "numwant": numwant
         }
 
-        # Send GET request to tracker
+        # Send GET request to tracker, reusing the keep-alive connection of the session if one is given
         try:
-            tracker_response = requests.get(tracker_url, request_payload, timeout=Tracker.PEER_INACTIVITY_TIMEOUT)
-        except requests.exceptions.ConnectionError:
+            http = session if session else requests
+            tracker_response = http.get(tracker_url, request_payload, timeout=timeout or Tracker.PEER_INACTIVITY_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             return [503, {"failure reason": "Tracker unavailable: No response"}]
 
-        # Decode the response to retrieve the dictionary
+        # Decode the response to retrieve the dictionary (compact peer lists are binary, so decode the raw bytes)
         try:
-            response_text = bencode.decode(tracker_response.text)
+            response_text = bencode.decode(tracker_response.content)
         except bencode.BencodeDecodeError:
             return [503, {"failure reason": "Failed to decode response"}]
 
@@ -150,70 +780,532 @@ class Tracker():
         return [tracker_response.status_code, response_text]
 
 
-    def build_verbose_peer_list(self, info_hash: str, requesting_peer_id: str) -> list[dict]:
-        peers = []
+    """Retrieve swarm statistics for many torrents from an HTTP tracker without announcing"""
+    @classmethod
+    def send_scrape_request(cls, tracker_url: str, info_hashes: list = None, timeout = None, session: requests.Session = None):
+        scrape_url = tracker_url.rstrip("/") + "/scrape"
+
+        try:
+            http = session if session else requests
+            tracker_response = http.get(scrape_url, {"info_hash": info_hashes or []}, timeout=timeout or Tracker.PEER_INACTIVITY_TIMEOUT)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            return [503, {"failure reason": "Tracker unavailable: No response"}]
+
+        try:
+            response_text = SCRAPE_DECODER.decode(tracker_response.content)
+        except bencode.BencodeDecodeError:
+            return [503, {"failure reason": "Failed to decode response"}]
+
+        return [tracker_response.status_code, response_text]
+
+
+    """Announce to a UDP tracker (BEP 15), the response has the same shape as send_tracker_request()"""
+    @classmethod
+    def send_udp_tracker_request(cls, peer_id: str,
+                                 peer_port: int,
+                                 peer_address: str,
+                                 tracker_url: str,
+                                 info_hash: bytes,
+                                 seeding: bool = False,
+                                 event: str = "started",
+                                 numwant: int = None,
+                                 timeout: float = None):
+
+        parsed_url = urllib.parse.urlparse(tracker_url)
+        tracker_address = (parsed_url.hostname, parsed_url.port)
+
+        if isinstance(info_hash, str):
+            info_hash = info_hash.encode("latin-1")
+
+        try:
+            raw_ip = struct.unpack("!I", socket.inet_aton(peer_address))[0] if peer_address else 0
+        except OSError:
+            raw_ip = 0
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout or Tracker.UDP_TIMEOUT)
+
+            for _ in range(Tracker.UDP_RETRIES):
+                reused_connection = tracker_address in cls.udp_connections
+                try:
+                    connection_id = cls.get_udp_connection_id(sock, tracker_address)
+                    if connection_id is None:
+                        continue
+
+                    transaction_id = struct.unpack("!I", os.urandom(4))[0]
+                    request = struct.pack(
+                        "!QII20s20sQQQIIIiH",
+                        connection_id,
+                        UDP_ANNOUNCE_ACTION,
+                        transaction_id,
+                        info_hash,
+                        peer_id.encode("utf-8"),
+                        0,
+                        0 if seeding else 1000,
+                        0,
+                        UDP_EVENT_IDS.get(event, 0),
+                        raw_ip,
+                        0,
+                        -1 if numwant is None else numwant,
+                        peer_port
+                    )
+                    sock.sendto(request, tracker_address)
+                    response = cls.receive_udp_response(sock, tracker_address, transaction_id)
+                except OSError:
+                    # Timed out or tracker unreachable, try again with a fresh connection id
+                    cls.udp_connections.pop(tracker_address, None)
+                    continue
+
+                if response is None:
+                    continue
+
+                action, payload = response
+                if action == UDP_ERROR_ACTION:
+                    cls.udp_connections.pop(tracker_address, None)
+                    # Cached connection id may have expired on the tracker (e.g. it restarted), retry with a new one
+                    if reused_connection:
+                        continue
+                    failure_reason = payload.decode("utf-8", errors="replace")
+                    if DEBUG_MODE:
+                        print(f"Failed to get peer list from tracker: {failure_reason}", file=sys.stderr)
+                    return [403, {"failure reason": failure_reason}]
+
+                if action != UDP_ANNOUNCE_ACTION or len(payload) < UDP_ANNOUNCE_RESPONSE_LENGTH - 8:
+                    return [503, {"failure reason": "Failed to decode response"}]
+
+                interval, leechers, seeders = struct.unpack("!III", payload[:12])
+                return [200, {
+                    "interval": interval,
+                    "complete": seeders,
+                    "incomplete": leechers,
+                    "peers": payload[12:]
+                }]
+
+        return [503, {"failure reason": "Tracker unavailable: No response"}]
+
+
+    """Reuse a connection id for up to a minute, otherwise ask the tracker for a new one"""
+    @classmethod
+    def get_udp_connection_id(cls, sock: socket.socket, tracker_address: tuple):
+        cached = cls.udp_connections.get(tracker_address)
+        if cached and time.time() - cached[1] < UDP_CONNECTION_ID_LIFETIME:
+            return cached[0]
+
+        transaction_id = struct.unpack("!I", os.urandom(4))[0]
+        sock.sendto(struct.pack("!QII", UDP_PROTOCOL_ID, UDP_CONNECT_ACTION, transaction_id), tracker_address)
+
+        response = cls.receive_udp_response(sock, tracker_address, transaction_id)
+        if response is None or response[0] != UDP_CONNECT_ACTION or len(response[1]) < 8:
+            return None
+
+        connection_id = struct.unpack("!Q", response[1][:8])[0]
+        cls.udp_connections[tracker_address] = (connection_id, time.time())
+        return connection_id
+
+
+    """Wait for the datagram answering the transaction, returns (action, payload)"""
+    @staticmethod
+    def receive_udp_response(sock: socket.socket, tracker_address: tuple, transaction_id: int):
+        while True:
+            response, _ = sock.recvfrom(UDP_MAX_DATAGRAM_SIZE)
+            if len(response) < 8:
+                continue
+
+            action, response_transaction_id = struct.unpack("!II", response[:8])
+            # Ignore late answers to earlier attempts
+            if response_transaction_id == transaction_id:
+                return action, response[8:]
+
+
+    """Bencoded peer list for an HTTP announce response"""
+    def encode_peer_list(self, info_hash: str, requesting_peer_id: str, compact: bool = False, numwant: int = DEFAULT_NUMWANT, seeding: bool = False) -> bytes:
+        peers = self.get_encoded_peers(info_hash, requesting_peer_id, compact, numwant, seeding)
+
+        if compact:
+            return b"%d:%s" % (len(peers), peers)
+        return b"l%se" % peers
+
+
+    """
+    Concatenated compact or bencoded entries of the sampled peers, without the surrounding string or list
+    When the whole swarm fits in numwant, the cached encoding of the swarm is reused and only the
+    requesting peer is cut out of it
+    """
+    def get_encoded_peers(self, info_hash: str, requesting_peer_id: str, compact: bool = False, numwant: int = DEFAULT_NUMWANT, seeding: bool = False) -> bytes:
+        with self.lock:
+            swarm = self.torrents.get(info_hash)
+
+            if not swarm:
+                peers = b''
+            elif len(swarm) - (requesting_peer_id in swarm) <= numwant:
+                peers, offsets = swarm.encode_peers(compact)
+                if span := offsets.get(requesting_peer_id):
+                    peers = peers[:span[0]] + peers[span[1]:]
+            else:
+                sample = swarm.sample_peers(numwant, requesting_peer_id, prefer_seeders=not seeding)
+                if compact:
+                    peers = b''.join(peer.to_compact() for peer in sample)
+                else:
+                    peers = b''.join(peer.to_bencode() for peer in sample)
 
-        for peer_id, peer in self.torrents[info_hash].items():
-            # Exclude the peer who requested the peer list from the response
-            if peer_id != requesting_peer_id:
-                peer_data = {
-                    "peer id": peer_id,
-                    "ip": peer[0],
-                    "port": peer[1],
-                    "seeding": peer[2]
-                }
-                peers.append(peer_data)
-        
         return peers
 
 
+    """Convert the peers of a tracker response into the verbose format regardless of how they were sent"""
+    @staticmethod
+    def decode_peer_list(peers) -> list[dict]:
+        if isinstance(peers, list):
+            return peers
+
+        # The bencode decoder returns strings which happen to be valid UTF-8 as str
+        if isinstance(peers, str):
+            peers = peers.encode("utf-8")
+
+        peer_list = []
+        for offset in range(0, len(peers) - COMPACT_PEER_LENGTH + 1, COMPACT_PEER_LENGTH):
+            port = struct.unpack("!H", peers[offset + 4:offset + COMPACT_PEER_LENGTH])[0]
+            peer_list.append({
+                "peer id": None,
+                "ip": socket.inet_ntoa(peers[offset:offset + 4]),
+                "port": port,
+                "seeding": None
+            })
+
+        return peer_list
+
+
     def get_peer_count(self):
-        return sum(len(self.torrents[info_hash]) for info_hash in self.torrents)
+        return self.peer_count
 
 
-    def has_peer(self, info_hash: str, address: str, port: int):
-        peers = self.torrents.get(info_hash)
+    def get_seeder_count(self):
+        return self.seeder_count
+
+
+    def get_leecher_count(self):
+        return self.peer_count - self.seeder_count
+
+
+    """(seeders, leechers, completed downloads) of a torrent"""
+    def get_swarm_stats(self, info_hash: str) -> tuple[int, int, int]:
+        with self.lock:
+            swarm = self.torrents.get(info_hash)
+            if swarm is None:
+                return (0, 0, 0)
+            return (swarm.seeders, swarm.leechers, swarm.completed)
+
+
+    def owns(self, info_hash: str):
+        return self.shard is None or self.shard.owns(info_hash)
+
+
+    def forward_request(self, info_hash: str, path: str):
+        return self.shard.forward(self.shard.owner(info_hash), path)
+
+
+    """
+    Statistics of many torrents at once, torrents owned by other shards are asked for in one request per shard
+    When no info hashes are given every shard reports all of its torrents
+    """
+    def scrape_all_shards(self, info_hashes: list[str] = None) -> dict[str, tuple[int, int, int]]:
+        if self.shard is None:
+            return self.scrape(info_hashes)
+
+        if info_hashes:
+            shard_hashes = {}
+            for info_hash in info_hashes:
+                shard_hashes.setdefault(self.shard.owner(info_hash), []).append(info_hash)
+        else:
+            shard_hashes = {shard_index: [] for shard_index in range(self.shard.count)}
+
+        stats = {}
+        for shard_index, hashes in shard_hashes.items():
+            if shard_index == self.shard.index:
+                stats.update(self.scrape(hashes))
+                continue
+
+            query = urllib.parse.urlencode([("info_hash", info_hash) for info_hash in hashes], encoding="latin-1")
+            status_code, payload = self.shard.forward(shard_index, "/scrape?" + query)
+            if status_code != 200:
+                continue
+
+            try:
+                files = SCRAPE_DECODER.decode(payload).get("files", {})
+            except bencode.BencodeDecodeError:
+                continue
+
+            for raw_info_hash, file_stats in files.items():
+                # Keys which happen to be valid UTF-8 are decoded as str
+                if isinstance(raw_info_hash, str):
+                    raw_info_hash = raw_info_hash.encode("utf-8")
+                stats[raw_info_hash.decode("latin-1")] = (file_stats["complete"], file_stats["incomplete"], file_stats["downloaded"])
+
+        return stats
+
+
+    """Statistics of many torrents at once, all torrents are included when no info hashes are given"""
+    def scrape(self, info_hashes: list[str] = None) -> dict[str, tuple[int, int, int]]:
+        with self.lock:
+            if not info_hashes:
+                info_hashes = list(self.torrents)
+            return {info_hash: self.get_swarm_stats(info_hash) for info_hash in info_hashes}
+
 
-        if not peers:
+    """Take one announce from the token buckets of the peer id and the client address"""
+    def allow_client(self, peer_id: str, client_address: str):
+        if not self.rate_limit:
+            return True
+
+        return self.peer_limiter.try_acquire(peer_id) and self.address_limiter.try_acquire(client_address)
+
+
+    """
+    Whether a regular announce comes before min interval has passed since the peer's last one
+    Stopped and completed events are always let through so the swarm stays accurate
+    """
+    def announced_recently(self, info_hash: str, peer_id: str, event: str):
+        if not self.rate_limit or event in ("stopped", "completed"):
             return False
 
-        for peer_tuple in peers.values():
-            if peer_tuple[0] == address and peer_tuple[1] == port:
-                return True
+        # Read without the lock, a stale answer only lets one announce through or refuses it one interval longer
+        swarm = self.torrents.get(info_hash)
+        peer = swarm.get_peer(peer_id) if swarm else None
+        return peer is not None and time.time() - peer.last_seen < self.min_interval
 
-        return False
 
+    def has_peer(self, info_hash: str, address: str, port: int):
+        swarm = self.torrents.get(info_hash)
 
-    def try_add_peer(self, info_hash: str, peer_id: str, address: str, port: int, seeding: bool):
-        if self.has_peer(info_hash, address, port) or self.get_peer_count() == Tracker.MAX_PEERS:
+        if not swarm:
             return False
 
-        peer_tuple = (address, port, seeding, time.time())
+        return swarm.find_peer(address, port) is not None
 
-        if info_hash in self.torrents:
-            self.torrents[info_hash][peer_id] = peer_tuple
-        else:
-            self.torrents[info_hash] = {peer_id: peer_tuple}
+
+    def try_add_peer(self, info_hash: str, peer_id: str, address: str, port: int, seeding: bool):
+        with self.lock:
+            swarm = self.torrents.get(info_hash)
+            if swarm is None:
+                swarm = Swarm(info_hash)
+                self.torrents[info_hash] = swarm
+
+            peer = swarm.get_peer(peer_id)
+
+            # Re-announce from a known peer, refresh its timestamp instead of rejecting it
+            if peer and peer.endpoint() == (address, port):
+                peer.last_seen = time.time()
+                self.set_seeding(swarm, peer, seeding)
+                return True
+
+            # Peer moved to a new address, or a new peer id took over the address (e.g. the client restarted)
+            if peer:
+                self.remove_peer(info_hash, peer_id)
+            if stale_peer := swarm.find_peer(address, port):
+                self.remove_peer(info_hash, stale_peer.peer_id)
+
+            if self.peer_count >= self.max_peers:
+                # Do not keep a swarm around which has no peers
+                if not swarm and not swarm.completed:
+                    self.torrents.pop(info_hash, None)
+                return False
+
+            self.add_peer_record(info_hash, swarm, PeerRecord(peer_id, address, port, seeding))
         
         return True
+
+
+    def add_peer_record(self, info_hash: str, swarm: Swarm, peer: PeerRecord):
+        swarm.add_peer(peer)
+        self.schedule_expiry(info_hash, peer)
+        # Swarm may have been dropped while removing a stale peer
+        self.torrents[info_hash] = swarm
+
+        self.peer_count += 1
+        if peer.seeding:
+            self.seeder_count += 1
+
+
+    """Peer finished downloading, count the download once and keep the peer as a seeder"""
+    def complete_peer(self, info_hash: str, peer_id: str, address: str, port: int):
+        with self.lock:
+            swarm = self.torrents.get(info_hash)
+            peer = swarm.get_peer(peer_id) if swarm else None
+            was_seeding = peer is not None and peer.seeding
+
+            if not self.try_add_peer(info_hash, peer_id, address, port, True):
+                return False
+
+            if not was_seeding:
+                self.torrents[info_hash].completed += 1
+
+            return True
+
+
+    def set_seeding(self, swarm: Swarm, peer: PeerRecord, seeding: bool):
+        if peer.seeding == seeding:
+            return
+
+        swarm.set_seeding(peer, seeding)
+        self.seeder_count += 1 if seeding else -1
     
 
     def remove_peer(self, info_hash, peer_id):
-        del self.torrents[info_hash][peer_id]
+        with self.lock:
+            swarm = self.torrents.get(info_hash)
+            if not swarm:
+                return None
+
+            peer = swarm.remove_peer(peer_id)
+            if peer is None:
+                return None
+
+            self.peer_count -= 1
+            if peer.seeding:
+                self.seeder_count -= 1
+
+            # Keep empty swarms which still have a download count for scrapes
+            if not swarm and not swarm.completed:
+                del self.torrents[info_hash]
+
+            return peer
+
+
+    def schedule_expiry(self, info_hash: str, peer: PeerRecord):
+        deadline = peer.last_seen + Tracker.PEER_INACTIVITY_TIMEOUT
+        heapq.heappush(self.expiry_queue, (deadline, next(self.expiry_sequence), info_hash, peer))
+
+
+    """
+    Remove peers whose deadline has passed
+    Re-announces only refresh last_seen, so a peer popped before its real deadline is pushed back once
+    """
+    def remove_unresponsive_peers(self):
+        expired = 0
+
+        with self.lock:
+            now = time.time()
+
+            while self.expiry_queue and self.expiry_queue[0][0] <= now:
+                _, _, info_hash, peer = heapq.heappop(self.expiry_queue)
+                swarm = self.torrents.get(info_hash)
 
+                # Peer already left or was replaced by a newer record
+                if not swarm or swarm.get_peer(peer.peer_id) is not peer:
+                    continue
 
-    def remove_unresponsive_peers(self, info_hash: str):
-        peers_to_remove = []
+                if now - peer.last_seen < Tracker.PEER_INACTIVITY_TIMEOUT:
+                    self.schedule_expiry(info_hash, peer)
+                    continue
 
-        for peer_id, peer in self.torrents[info_hash].items():
-            timestamp = peer[3]
-            if time.time() - timestamp >= Tracker.PEER_INACTIVITY_TIMEOUT:
-                peers_to_remove.append(peer_id)
+                if LOG_REQUESTS:
+                    print("Dead peer removed: ", peer.address, peer.port, now - peer.last_seen)
+                self.remove_peer(info_hash, peer.peer_id)
+                expired += 1
 
-        for peer_id in peers_to_remove:
-            if DEBUG_MODE:
-                print("Dead peer removed: ", peer[0], peer[1], time.time() - peer[3])
-            self.remove_peer(info_hash, peer_id)
+        if expired:
+            self.stats.record_expired(expired)
+
+
+    def run_maintenance(self):
+        while not self.stop_event.wait(Tracker.EXPIRY_INTERVAL):
+            self.remove_unresponsive_peers()
+
+            if self.snapshot_path and time.time() - self.last_snapshot >= Tracker.SNAPSHOT_INTERVAL:
+                self.save_snapshot()
+
+            if time.time() - self.last_rate_limit_cleanup >= Tracker.RATE_LIMIT_CLEANUP_INTERVAL:
+                self.peer_limiter.remove_idle()
+                self.address_limiter.remove_idle()
+                self.last_rate_limit_cleanup = time.time()
+
+
+    """
+    Write the registry to the snapshot path
+    Peers are copied under the lock and serialized outside of it, so announces are only blocked for the copy
+    """
+    def save_snapshot(self, snapshot_path: str = None):
+        snapshot_path = snapshot_path or self.snapshot_path
+
+        with self.lock:
+            torrents = {
+                info_hash: {
+                    "completed": swarm.completed,
+                    "peers": [(p.peer_id, p.address, p.port, p.seeding, p.last_seen) for p in swarm.peers.values()]
+                }
+                for info_hash, swarm in self.torrents.items()
+            }
+
+        snapshot = {
+            "version": Tracker.SNAPSHOT_FORMAT_VERSION,
+            "saved": time.time(),
+            "torrents": torrents
+        }
+
+        # Write to a temporary file first so a crash never leaves a half written snapshot behind
+        temp_path = snapshot_path + ".tmp"
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(snapshot, file, separators=(",", ":"))
+            os.replace(temp_path, snapshot_path)
+        except OSError as e:
+            print(f"Failed to save tracker snapshot to {snapshot_path}: {e}", file=sys.stderr)
+            return False
+        finally:
+            self.last_snapshot = time.time()
+
+        return True
+
+
+    """Restore peers which have not expired yet, they keep their last announce time and expire normally"""
+    def load_snapshot(self, snapshot_path: str):
+        try:
+            with open(snapshot_path, "r") as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            print(f"Failed to load tracker snapshot from {snapshot_path}: {e}", file=sys.stderr)
+            return False
+
+        if snapshot.get("version") != Tracker.SNAPSHOT_FORMAT_VERSION:
+            print(f"Ignoring tracker snapshot with unknown version: {snapshot.get('version')}", file=sys.stderr)
+            return False
+
+        now = time.time()
+
+        with self.lock:
+            for info_hash, torrent in snapshot.get("torrents", {}).items():
+                swarm = self.torrents.get(info_hash) or Swarm(info_hash)
+                swarm.completed = torrent.get("completed", 0)
+
+                for peer_id, address, port, seeding, last_seen in torrent.get("peers", []):
+                    if now - last_seen >= Tracker.PEER_INACTIVITY_TIMEOUT or self.peer_count >= self.max_peers:
+                        continue
+                    if peer_id in swarm or swarm.find_peer(address, port):
+                        continue
+                    self.add_peer_record(info_hash, swarm, PeerRecord(peer_id, address, port, seeding, last_seen))
+
+                if swarm or swarm.completed:
+                    self.torrents[info_hash] = swarm
+
+        if DEBUG_MODE:
+            print(f"Restored {self.peer_count} peers in {len(self.torrents)} torrents from {snapshot_path}")
+
+        return True
+
+
+    def start_maintenance(self):
+        self.stop_event.clear()
+        self.maintenance_thread = Thread(target = self.run_maintenance)
+        self.maintenance_thread.daemon = True
+        self.maintenance_thread.start()
+
+
+    def stop_maintenance(self):
+        self.stop_event.set()
+        if self.maintenance_thread:
+            self.maintenance_thread.join()
+            self.maintenance_thread = None
 
 
     def handle_requests(self):
@@ -221,41 +1313,66 @@ class Tracker():
             print(f"Listening for peer requests on {self.address}...")
 
         try:
-            while self.running:
-                self._server.handle_request()
-
-                for info_hash in self.torrents:
-                    self.remove_unresponsive_peers(info_hash)
-
+            # Returns once stop() requests a shutdown
+            self._server.serve_forever(Tracker.POLL_INTERVAL)
         except (SystemExit, KeyboardInterrupt):
             self.running = False
+            self.stop_maintenance()
 
 
     def start(self, new_thread: bool = False):
         self.running = True
+        self.start_maintenance()
+
+        if self.internal_server:
+            self.internal_thread = Thread(target = self.internal_server.serve_forever, args=(Tracker.POLL_INTERVAL,))
+            self.internal_thread.daemon = True
+            self.internal_thread.start()
+
+        if self.udp_server:
+            self.udp_thread = Thread(target = self.udp_server.serve)
+            self.udp_thread.daemon = True
+            self.udp_thread.start()
 
+        # Set before serving starts, so a stop() racing with start() still shuts the server down
         if new_thread:
             self.thread = Thread(target = self.handle_requests)
+            self.serving_thread = self.thread
             self.thread.start()
         else:
+            self.serving_thread = current_thread()
             self.handle_requests()
     
 
     def stop(self):
         if self.running:
             self.running = False
-            if self.thread:
+            # Must not be called from the serving thread or it will deadlock
+            if self.serving_thread and self.serving_thread is not current_thread():
+                self._server.shutdown()
+            if self.thread and self.thread is not current_thread():
                 self.thread.join()
                 self.thread = None
+            self.stop_maintenance()
+            if self.internal_thread:
+                self.internal_server.shutdown()
+                self.internal_thread.join()
+                self.internal_thread = None
+            if self.udp_thread:
+                self.udp_thread.join()
+                self.udp_thread = None
+            if self.snapshot_path:
+                self.save_snapshot()
 
 
     def __str__(self):
         table = PrettyTable()
         table.field_names = ["Peer ID", "IP Address", "Port", "Seeding"]
 
-        for info_hash in self.torrents:
-            for peer_id, peer in self.torrents[info_hash].items():
-                table.add_row([peer_id, peer[0], peer[1], peer[2]])
+        with self.lock:
+            for swarm in self.torrents.values():
+                for peer in swarm.peers.values():
+                    table.add_row([peer.peer_id, peer.address, peer.port, peer.seeding])
 
         return table.get_string()
 
@@ -263,4 +1380,8 @@ class Tracker():
     def __del__(self):
         self.stop()
         self._server.server_close()
+        if self.internal_server:
+            self.internal_server.server_close()
+        if self.udp_server:
+            self.udp_server.server_close()
 
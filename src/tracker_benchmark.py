@@ -0,0 +1,241 @@
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
+from tracker import Tracker
+import tracker
+import argparse
+import hashlib
+import http.client
+import multiprocessing
+import random
+import socket
+import struct
+import sys
+import time
+import urllib.parse
+
+DEFAULT_EVENT_MIX = "started=90,completed=5,stopped=5"
+PERCENTILES = [("p50", 0.5), ("p99", 0.99), ("p999", 0.999)]
+
+
+def parse_event_mix(event_mix: str) -> tuple[list[str], list[int]]:
+    events, weights = [], []
+
+    for entry in event_mix.split(","):
+        event, weight = entry.split("=")
+        if event not in ("started", "completed", "stopped"):
+            raise argparse.ArgumentTypeError(f"Unknown event: {event}")
+        events.append(event)
+        weights.append(int(weight))
+
+    return events, weights
+
+
+def info_hash_for(torrent_index: int) -> bytes:
+    return hashlib.sha1(f"benchmark-torrent-{torrent_index}".encode()).digest()
+
+
+"""Unique peer id and endpoint for each synthetic peer"""
+def peer_for(peer_index: int, torrent_count: int):
+    peer_id = "-BM0000-%012d" % peer_index
+    address = socket.inet_ntoa(struct.pack("!I", (10 << 24) + peer_index + 1))
+    port = 1024 + peer_index % 60000
+    return peer_id, address, port, info_hash_for(peer_index % torrent_count)
+
+
+def announce_http(connection: http.client.HTTPConnection, query: str):
+    connection.request("GET", "/?" + query)
+    response = connection.getresponse()
+    payload = response.read()
+    return response.status == 200, len(payload)
+
+
+"""
+Drive announces from one worker thread over a single keep-alive connection (or UDP socket)
+Returns the latency of every announce, the number of failed announces and the response bytes received
+"""
+def run_worker(args, tracker_address: tuple, udp: bool, worker_index: int, announce_count: int, events: list[str], weights: list[int]):
+    rng = random.Random(worker_index)
+    latencies = []
+    errors = 0
+    response_bytes = 0
+
+    connection = None if udp else http.client.HTTPConnection(*tracker_address, timeout=args.timeout)
+
+    for _ in range(announce_count):
+        peer_index = rng.randrange(args.peers)
+        peer_id, address, port, info_hash = peer_for(peer_index, args.torrents)
+        event = rng.choices(events, weights)[0]
+
+        start = time.perf_counter()
+        try:
+            if udp:
+                status_code, response = Tracker.send_udp_tracker_request(
+                    peer_id, port, address, f"udp://{tracker_address[0]}:{tracker_address[1]}",
+                    info_hash, False, event, args.numwant, timeout=args.timeout)
+                ok = status_code == 200
+                response_bytes += len(response.get("peers", b''))
+            else:
+                query = urllib.parse.urlencode({
+                    "info_hash": info_hash,
+                    "peer_id": peer_id,
+                    "peer_address": address,
+                    "port": port,
+                    "event": event,
+                    "compact": int(args.compact),
+                    "seeding": event == "completed",
+                    "numwant": args.numwant
+                })
+                ok, size = announce_http(connection, query)
+                response_bytes += size
+        except (OSError, http.client.HTTPException):
+            ok = False
+            if connection:
+                connection.close()
+                connection = http.client.HTTPConnection(*tracker_address, timeout=args.timeout)
+
+        latencies.append(time.perf_counter() - start)
+        if not ok:
+            errors += 1
+
+    if connection:
+        connection.close()
+
+    return latencies, errors, response_bytes
+
+
+"""Runs in each generator process, spreads its announces over several threads"""
+def run_generator(args, tracker_address: tuple, udp: bool, process_index: int, announce_count: int):
+    events, weights = parse_event_mix(args.event_mix)
+    results = [None] * args.concurrency
+    threads = []
+
+    for i in range(args.concurrency):
+        count = announce_count // args.concurrency + (i < announce_count % args.concurrency)
+        worker_index = process_index * args.concurrency + i
+
+        def target(i=i, count=count, worker_index=worker_index):
+            results[i] = run_worker(args, tracker_address, udp, worker_index, count, events, weights)
+
+        thread = Thread(target = target)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    latencies, errors, response_bytes = [], 0, 0
+    for worker_latencies, worker_errors, worker_bytes in results:
+        latencies.extend(worker_latencies)
+        errors += worker_errors
+        response_bytes += worker_bytes
+
+    return latencies, errors, response_bytes
+
+
+"""Announce every synthetic peer once so the measured run starts from populated swarms"""
+def populate(args, tracker_address: tuple):
+    connection = http.client.HTTPConnection(*tracker_address, timeout=args.timeout)
+
+    for peer_index in range(args.peers):
+        peer_id, address, port, info_hash = peer_for(peer_index, args.torrents)
+        query = urllib.parse.urlencode({
+            "info_hash": info_hash,
+            "peer_id": peer_id,
+            "peer_address": address,
+            "port": port,
+            "event": "started",
+            "compact": 1,
+            "seeding": peer_index % 10 == 0,
+            "numwant": 0
+        })
+        announce_http(connection, query)
+
+    connection.close()
+
+
+def percentile(sorted_values: list[float], fraction: float):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def parse_args(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Announce load generator and latency benchmark for the tracker")
+    parser.add_argument("--tracker", help="address:port of a running tracker, a local tracker is started when omitted")
+    parser.add_argument("--udp", action="store_true", help="announce over the UDP tracker protocol")
+    parser.add_argument("--peers", type=int, default=10000, help="number of synthetic peers")
+    parser.add_argument("--torrents", type=int, default=100, help="number of torrents the peers are spread over")
+    parser.add_argument("--announces", type=int, default=20000, help="total number of measured announces")
+    parser.add_argument("--processes", type=int, default=1, help="generator processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="connections per generator process")
+    parser.add_argument("--event-mix", default=DEFAULT_EVENT_MIX, help=f"event weights (default: {DEFAULT_EVENT_MIX})")
+    parser.add_argument("--numwant", type=int, default=Tracker.DEFAULT_NUMWANT, help="peers requested per announce")
+    parser.add_argument("--verbose-peers", dest="compact", action="store_false", help="request verbose instead of compact peer lists")
+    parser.add_argument("--no-populate", dest="populate", action="store_false", help="do not announce every peer before measuring")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for each announce")
+    parser.add_argument("--workers", type=int, default=Tracker.DEFAULT_WORKER_COUNT, help="worker threads of the local tracker")
+    parser.add_argument("--quiet", action="store_true", help="disable debug output of the local tracker")
+
+    args = parser.parse_args(argv)
+    parse_event_mix(args.event_mix)
+    return args
+
+
+def main(argv: list[str] = None):
+    args = parse_args(argv)
+    local_tracker = None
+
+    if args.tracker:
+        host, port = args.tracker.rsplit(":", 1)
+        tracker_address = (host, int(port))
+    else:
+        if args.quiet:
+            tracker.DEBUG_MODE = False
+        # Every synthetic peer announces from the same address, often well within min interval
+        local_tracker = Tracker("127.0.0.1", 0, max_workers=args.workers, max_peers=args.peers * 2, udp_port=0 if args.udp else None, rate_limit=False)
+        local_tracker.start(new_thread=True)
+        tracker_address = local_tracker.udp_address if args.udp else local_tracker.address
+
+    # The UDP and HTTP ports of a remote tracker are assumed to be the same
+    http_address = local_tracker.address if local_tracker else tracker_address
+
+    try:
+        if args.populate:
+            populate(args, http_address)
+
+        start = time.perf_counter()
+
+        if args.processes > 1:
+            with ProcessPoolExecutor(args.processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = [
+                    executor.submit(run_generator, args, tracker_address, args.udp, i,
+                                    args.announces // args.processes + (i < args.announces % args.processes))
+                    for i in range(args.processes)
+                ]
+                results = [future.result() for future in futures]
+        else:
+            results = [run_generator(args, tracker_address, args.udp, 0, args.announces)]
+
+        elapsed = time.perf_counter() - start
+    finally:
+        if local_tracker:
+            local_tracker.stop()
+
+    latencies, errors, response_bytes = [], 0, 0
+    for process_latencies, process_errors, process_bytes in results:
+        latencies.extend(process_latencies)
+        errors += process_errors
+        response_bytes += process_bytes
+    latencies.sort()
+
+    print(f"announces:      {len(latencies)} ({errors} failed) in {elapsed:.2f}s")
+    print(f"throughput:     {len(latencies) / elapsed:.0f} announces/sec")
+    for name, fraction in PERCENTILES:
+        print(f"latency {name + ':':<7} {percentile(latencies, fraction) * 1000:.2f} ms")
+    print(f"response size:  {response_bytes / max(1, len(latencies)):.0f} bytes on average")
+
+    return 0 if errors == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from tracker import Tracker
+import urllib.parse
+import requests
+
+DEBUG_MODE = True
+
+class TrackerClient():
+    # Seconds to wait for a TCP connection to a tracker, dead trackers should fail fast
+    DEFAULT_CONNECT_TIMEOUT = 3
+    # Seconds to wait for the announce response once connected
+    DEFAULT_READ_TIMEOUT = 10
+    # Number of trackers announced to at the same time
+    DEFAULT_WORKER_COUNT = 8
+
+
+    def __init__(self, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT, max_workers: int = DEFAULT_WORKER_COUNT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # One keep-alive session per tracker host, scheme://host:port -> session
+        self.sessions: dict[str, requests.Session] = {}
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers, "tracker-announce")
+
+
+    def get_session(self, tracker_url: str) -> requests.Session:
+        parsed_url = urllib.parse.urlparse(tracker_url)
+        host = f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                self.sessions[host] = session
+
+        return session
+
+
+    def announce(self, tracker_url: str,
+                 peer_id: str,
+                 peer_port: int,
+                 peer_address: str,
+                 info_hash: bytes,
+                 seeding: bool = False,
+                 event: str = "started",
+                 compact: int = 1,
+                 numwant: int = None):
+
+        if tracker_url.lower().startswith("udp"):
+            # UDP trackers always answer with compact peer lists
+            return Tracker.send_udp_tracker_request(
+                peer_id,
+                peer_port,
+                peer_address,
+                tracker_url,
+                info_hash,
+                seeding,
+                event,
+                numwant,
+                timeout=self.connect_timeout
+            )
+
+        return Tracker.send_tracker_request(
+            peer_id,
+            peer_port,
+            peer_address,
+            tracker_url,
+            info_hash,
+            seeding,
+            event,
+            compact,
+            numwant,
+            session=self.get_session(tracker_url),
+            timeout=(self.connect_timeout, self.read_timeout)
+        )
+
+
+    """
+    Announce to every tracker at once and return (tracker url, response) of the first one to succeed
+    The remaining announces finish in the background, their responses are ignored
+    """
+    def announce_all(self, tracker_urls: list[str], *args, **kwargs):
+        if not tracker_urls:
+            return None, None
+
+        futures = {self.executor.submit(self.announce, tracker_url, *args, **kwargs): tracker_url for tracker_url in tracker_urls}
+        latest_url, latest_response = None, None
+
+        for future in as_completed(futures):
+            tracker_url = futures[future]
+            try:
+                tracker_response = future.result()
+            except Exception as e:
+                if DEBUG_MODE:
+                    print(f"Announce to {tracker_url} failed: {e}")
+                continue
+
+            latest_url, latest_response = tracker_url, tracker_response
+            if tracker_response[0] == 200:
+                return tracker_url, tracker_response
+
+        return latest_url, latest_response
+
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
@@ -0,0 +1,134 @@
+from threading import Lock
+import bisect
+import collections
+import time
+
+# Upper bounds of the histogram buckets, values above the last bound go into an overflow bucket
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+RESPONSE_SIZE_BUCKETS = [64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536]
+SWARM_SIZE_BUCKETS = [1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000]
+# Announce rate is averaged over this many seconds
+RATE_WINDOW = 60
+
+class Histogram():
+    def __init__(self, bounds: list[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+    def to_dict(self):
+        buckets = {f"le {bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["overflow"] = self.counts[-1]
+
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "buckets": buckets
+        }
+
+
+# Counters updated on the request path, kept cheap so the tracker can be observed without per-request logging
+class TrackerStats():
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.announces = 0
+        self.udp_announces = 0
+        self.scrapes = 0
+        self.failed_requests = 0
+        # Announces answered with a refusal because the client announced too often, also counted as failed
+        self.refused_announces = 0
+        self.expired_peers = 0
+        # (second, announces during that second) for the last RATE_WINDOW seconds
+        self.announce_seconds = collections.deque()
+        self.handler_latency = Histogram(LATENCY_BUCKETS)
+        self.response_bytes = Histogram(RESPONSE_SIZE_BUCKETS)
+
+
+    def record_announce(self, latency: float, response_size: int, failed: bool = False, udp: bool = False):
+        second = int(time.time())
+
+        with self.lock:
+            self.announces += 1
+            if udp:
+                self.udp_announces += 1
+            if failed:
+                self.failed_requests += 1
+
+            if self.announce_seconds and self.announce_seconds[-1][0] == second:
+                self.announce_seconds[-1][1] += 1
+            else:
+                self.announce_seconds.append([second, 1])
+                while self.announce_seconds[0][0] <= second - RATE_WINDOW:
+                    self.announce_seconds.popleft()
+
+            self.handler_latency.observe(latency)
+            self.response_bytes.observe(response_size)
+
+
+    def record_scrape(self):
+        with self.lock:
+            self.scrapes += 1
+
+
+    def record_refused(self):
+        with self.lock:
+            self.refused_announces += 1
+
+
+    def record_expired(self, peer_count: int):
+        with self.lock:
+            self.expired_peers += peer_count
+
+
+    def announce_rate(self):
+        cutoff = time.time() - RATE_WINDOW
+
+        with self.lock:
+            announces = sum(count for second, count in self.announce_seconds if second > cutoff)
+
+        # Average over the time the tracker has actually been running if that is shorter than the window
+        return announces / max(1, min(RATE_WINDOW, time.time() - self.started))
+
+
+    """Everything the /stats endpoint reports, swarm sizes are only walked here and not on the request path"""
+    def to_dict(self, tracker) -> dict:
+        swarm_sizes = Histogram(SWARM_SIZE_BUCKETS)
+
+        with tracker.lock:
+            for swarm in tracker.torrents.values():
+                swarm_sizes.observe(len(swarm))
+
+            registry = {
+                "torrents": len(tracker.torrents),
+                "peers": tracker.get_peer_count(),
+                "seeders": tracker.get_seeder_count(),
+                "leechers": tracker.get_leecher_count()
+            }
+
+        with self.lock:
+            counters = {
+                "uptime": time.time() - self.started,
+                "announces": self.announces,
+                "udp announces": self.udp_announces,
+                "scrapes": self.scrapes,
+                "failed requests": self.failed_requests,
+                "refused announces": self.refused_announces,
+                "expired peers": self.expired_peers,
+                "handler latency": self.handler_latency.to_dict(),
+                "response bytes": self.response_bytes.to_dict()
+            }
+
+        counters["announce rate"] = self.announce_rate()
+        counters["peers per torrent"] = swarm_sizes.to_dict()
+        counters.update(registry)
+
+        return counters
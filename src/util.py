@@ -1,6 +1,18 @@
+import socket
+
+
 def flatten(list):
     return [x for sublist in list for x in sublist]
 
 
 def clamp(x, minimum, maximum):
     return min(maximum, max(x, minimum))
+
+
+"""Dotted quad IPv4 address, hostnames and IPv6 addresses do not fit the compact peer format"""
+def is_ipv4_address(address: str):
+    try:
+        socket.inet_pton(socket.AF_INET, address)
+    except (OSError, TypeError):
+        return False
+    return True